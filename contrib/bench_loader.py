@@ -0,0 +1,64 @@
+# Compare the throughput of the local data file readers. Usage:
+#
+#   python contrib/bench_loader.py [path/to/entities.ftm.json]
+#
+# Without an argument, a test file is generated from the fixtures.
+import sys
+import time
+import orjson
+import asyncio
+import aiofiles
+import tempfile
+from pathlib import Path
+from typing import Any, AsyncGenerator
+
+from yente.data.loader import read_path_batches
+
+FIXTURE = Path(__file__).parent.parent / "tests/fixtures/donations.ijson"
+
+
+async def read_path_lines_aiofiles(path: Path) -> AsyncGenerator[Any, None]:
+    # The previous reader, with one thread round-trip per line:
+    async with aiofiles.open(path, "rb") as fh:
+        async for line in fh:
+            yield orjson.loads(line)
+
+
+async def bench_aiofiles(path: Path) -> int:
+    count = 0
+    async for _ in read_path_lines_aiofiles(path):
+        count += 1
+    return count
+
+
+async def bench_batches(path: Path) -> int:
+    count = 0
+    async for batch in read_path_batches(path):
+        count += len(batch)
+    return count
+
+
+async def main(path: Path) -> None:
+    size = path.stat().st_size / 1024 / 1024
+    print(f"File: {path} ({size:.1f} MB)")
+    for name, func in (("aiofiles lines", bench_aiofiles), ("batches", bench_batches)):
+        start = time.monotonic()
+        count = await func(path)
+        took = time.monotonic() - start
+        print(
+            f"{name:>16}: {count} entities in {took:.2f}s, "
+            f"{count / took:.0f} entities/s, {size / took:.1f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        asyncio.run(main(Path(sys.argv[1])))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "entities.ftm.json"
+            data = FIXTURE.read_bytes()
+            with open(path, "wb") as fh:
+                for _ in range(2000):
+                    fh.write(data)
+            asyncio.run(main(path))
@@ -0,0 +1,81 @@
+# Compare scoring match candidates one by one with the batched scoring path.
+# Usage:
+#
+#   python contrib/bench_scoring.py [algorithm]
+#
+# The candidates are taken from the test fixtures, repeated as needed. Batched
+# scoring is enabled with YENTE_SCORE_BATCH and requires `numpy`.
+import sys
+import time
+import orjson
+from pathlib import Path
+from itertools import cycle, islice
+from typing import List
+from followthemoney import model
+from nomenklatura.matching import get_algorithm
+
+from yente.data.entity import Entity
+from yente.data.common import EntityExample
+from yente.scoring import compare_batch
+
+FIXTURES = Path(__file__).parent.parent / "tests/fixtures"
+QUERIES = [
+    {
+        "schema": "Person",
+        "properties": {
+            "name": ["Lina Dachner"],
+            "birthDate": ["1971-01-22"],
+            "country": ["de"],
+        },
+    },
+    {
+        "schema": "Company",
+        "properties": {"name": ["Inter Tobacco LLC"], "jurisdiction": ["ru"]},
+    },
+]
+SIZES = [50, 500, 5000]
+ROUNDS = 3
+
+
+def load_candidates() -> List[Entity]:
+    entities: List[Entity] = []
+    for name in ("donations.ijson", "dataset/t1/entities.ftm.json"):
+        with open(FIXTURES / name, "rb") as fh:
+            for line in fh:
+                entity = Entity.from_dict(model, orjson.loads(line))
+                if entity.schema.is_a("LegalEntity"):
+                    entities.append(entity)
+    return entities
+
+
+def main(algorithm_name: str) -> None:
+    algorithm = get_algorithm(algorithm_name)
+    if algorithm is None:
+        raise SystemExit(f"Invalid algorithm: {algorithm_name}")
+    entities = load_candidates()
+    print(f"Algorithm: {algorithm.NAME}")
+    for size in SIZES:
+        candidates = list(islice(cycle(entities), size))
+        single = 0.0
+        batch = 0.0
+        for data in QUERIES:
+            query = Entity.from_example(EntityExample.model_validate(data))
+            # Warm up the caches of the matching functions for both paths:
+            compare_batch(algorithm, query, candidates)
+            for _ in range(ROUNDS):
+                start = time.perf_counter()
+                expected = [algorithm.compare(query, c) for c in candidates]
+                single += time.perf_counter() - start
+                start = time.perf_counter()
+                scores = compare_batch(algorithm, query, candidates)
+                batch += time.perf_counter() - start
+                assert scores == expected, "Batched scores differ"
+        runs = len(QUERIES) * ROUNDS
+        print(
+            f"{size:>5} candidates: one by one {single / runs * 1000:8.1f}ms, "
+            f"batched {batch / runs * 1000:8.1f}ms, speedup {single / batch:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "logic-v1")
@@ -61,6 +61,14 @@ setup(
             "black",
             "types-aiofiles>=24.0,<25.0",
             "boto3-stubs",
+            "zstandard",
+            "numpy>=1.26.0,<3.0.0",
+        ],
+        "zstd": [
+            "zstandard",
+        ],
+        "numpy": [
+            "numpy>=1.26.0,<3.0.0",
         ],
     },
     entry_points={
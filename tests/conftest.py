@@ -9,6 +9,7 @@ from yente import settings
 from yente.app import create_app
 from yente.search.indexer import update_index
 from yente.provider import with_provider, close_provider
+from yente.data.util import close_http_client
 
 
 run_id = uuid4().hex
@@ -48,6 +49,7 @@ async def search_provider():
 @pytest_asyncio.fixture(scope="session", autouse=True)
 async def load_data():
     await update_index(force=True)
+    await close_http_client()
     yield
 
 
@@ -58,3 +60,4 @@ async def flush_cached_es():
         yield
     finally:
         await close_provider()
+        await close_http_client()
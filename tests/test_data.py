@@ -1,10 +1,27 @@
+import re
+import bz2
+import asyncio
+import gzip
+import httpx
+import hashlib
+import lzma
+import orjson
 import pytest
+import zstandard
 from pathlib import Path
+from typing import Any
 
-from yente.data import get_catalog
-from yente.data.loader import load_json_lines
-from yente.data.util import get_url_local_path
-from yente.data.util import phonetic_names
+from yente import settings
+from yente.exc import DataIntegrityError
+from yente.data import get_catalog, loader
+from yente.data.loader import MEMO, load_json_lines, load_json_url, load_yaml_url
+from yente.data.loader import Prefetcher, get_url_digest
+from yente.data.manifest import Manifest
+from yente.data.mirror import mirror_catalog
+from yente.data.util import get_url_local_path, httpx_session
+from yente.data.util import get_http_client, get_http_metrics, close_http_client
+from yente.data.util import phonetic_names, index_name_parts, write_file_atomic
+from yente.data.names import NameFeatureCache, name_features
 
 
 @pytest.mark.asyncio
@@ -25,6 +42,198 @@ async def test_local_dataset():
     assert len(lines) > 10, lines
 
 
+COMPRESSORS = {
+    "gz": gzip.compress,
+    "bz2": bz2.compress,
+    "xz": lzma.compress,
+    "zst": zstandard.compress,
+}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("extension", COMPRESSORS.keys())
+async def test_compressed_json_lines(tmp_path: Path, extension: str):
+    data = Path(__file__).parent.joinpath("fixtures/donations.ijson").read_bytes()
+    compress = COMPRESSORS[extension]
+    path = tmp_path / f"donations.ijson.{extension}"
+    # Two concatenated members, as written by parallel compressors:
+    path.write_bytes(compress(data) + compress(data))
+    lines = [line async for line in load_json_lines(path.as_posix(), "test")]
+    assert len(lines) == 2 * len(data.strip().splitlines())
+
+    path.write_bytes(compress(data)[:-20])
+    with pytest.raises(RuntimeError):
+        [line async for line in load_json_lines(path.as_posix(), "test")]
+
+
+@pytest.mark.asyncio
+async def test_compressed_http_lines(httpx_mock: Any):
+    data = Path(__file__).parent.joinpath("fixtures/donations.ijson").read_bytes()
+    count = len(data.strip().splitlines())
+    url = "https://data.example.com/donations.ijson.gz"
+    httpx_mock.add_response(200, url=url, content=gzip.compress(data))
+    lines = [line async for line in load_json_lines(url, "test")]
+    assert len(lines) == count
+
+    url = "https://data.example.com/donations.ijson"
+    headers = {"Content-Encoding": "gzip"}
+    httpx_mock.add_response(200, url=url, content=gzip.compress(data), headers=headers)
+    lines = [line async for line in load_json_lines(url, "test")]
+    assert len(lines) == count
+
+
+@pytest.mark.asyncio
+async def test_segmented_download(httpx_mock: Any, tmp_path: Path, monkeypatch: Any):
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(settings, "STREAM_LOAD", False)
+    monkeypatch.setattr(settings, "DOWNLOAD_CONCURRENCY", 3)
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_SIZE", 1000)
+    data = Path(__file__).parent.joinpath("fixtures/donations.ijson").read_bytes()
+    url = "https://data.example.com/donations.ijson"
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(len(data))}
+    httpx_mock.add_response(200, method="HEAD", url=url, headers=headers)
+
+    def send_range(request: httpx.Request) -> httpx.Response:
+        match = re.match(r"bytes=(\d+)-(\d+)", request.headers["Range"])
+        assert match is not None
+        start, end = int(match.group(1)), int(match.group(2))
+        return httpx.Response(206, content=data[start : end + 1])
+
+    httpx_mock.add_callback(send_range, method="GET", url=url, is_reusable=True)
+    checksum = hashlib.sha1(data).hexdigest()
+    lines = [line async for line in load_json_lines(url, "test", checksum=checksum)]
+    assert lines == [orjson.loads(line) for line in data.strip().splitlines()]
+    assert not (tmp_path / "test").exists()
+
+    httpx_mock.add_response(200, method="HEAD", url=url, headers=headers)
+    with pytest.raises(DataIntegrityError):
+        [line async for line in load_json_lines(url, "test", checksum="banana")]
+    assert not (tmp_path / "test").exists()
+
+
+@pytest.mark.asyncio
+async def test_segmented_download_fallback(
+    httpx_mock: Any, tmp_path: Path, monkeypatch: Any
+):
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(settings, "STREAM_LOAD", False)
+    monkeypatch.setattr(settings, "DOWNLOAD_CONCURRENCY", 3)
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_SIZE", 1000)
+    data = Path(__file__).parent.joinpath("fixtures/donations.ijson").read_bytes()
+    expected = [orjson.loads(line) for line in data.strip().splitlines()]
+    checksum = hashlib.sha1(data).hexdigest()
+
+    # The server rejects HEAD requests, e.g. for a URL signed for GET only:
+    url = "https://data.example.com/signed/donations.ijson"
+    httpx_mock.add_response(403, method="HEAD", url=url)
+    httpx_mock.add_response(200, method="GET", url=url, content=data)
+    lines = [line async for line in load_json_lines(url, "test", checksum=checksum)]
+    assert lines == expected
+
+    # The server advertises range support, but sends the whole file:
+    url = "https://data.example.com/ranges/donations.ijson"
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(len(data))}
+    httpx_mock.add_response(200, method="HEAD", url=url, headers=headers)
+    httpx_mock.add_response(200, method="GET", url=url, content=data, is_reusable=True)
+    lines = [line async for line in load_json_lines(url, "test", checksum=checksum)]
+    assert lines == expected
+    requests = httpx_mock.get_requests(method="GET", url=url)
+    assert "Range" not in requests[-1].headers
+
+    # Only the first range is honored, so some lines have already been read:
+    url = "https://data.example.com/partial/donations.ijson"
+    httpx_mock.add_response(200, method="HEAD", url=url, headers=headers)
+
+    def send_first(request: httpx.Request) -> httpx.Response:
+        if request.headers.get("Range") == "bytes=0-999":
+            return httpx.Response(206, content=data[:1000])
+        return httpx.Response(200, content=data)
+
+    httpx_mock.add_callback(send_first, method="GET", url=url, is_reusable=True)
+    monkeypatch.setattr(settings, "DOWNLOAD_CONCURRENCY", 2)
+    lines = [line async for line in load_json_lines(url, "test", checksum=checksum)]
+    assert lines == expected
+    assert not (tmp_path / "test").exists()
+
+
+@pytest.mark.asyncio
+async def test_prefetch_budget(httpx_mock: Any, tmp_path: Path, monkeypatch: Any):
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    data = Path(__file__).parent.joinpath("fixtures/donations.ijson").read_bytes()
+    sources = []
+    for idx in range(3):
+        url = f"https://data.example.com/{idx}/donations.ijson"
+        httpx_mock.add_response(url=url, content=data)
+        sources.append((url, f"prefetch-{idx}.ijson"))
+
+    # Room for the file being read and one more:
+    prefetcher = Prefetcher(sources, ahead=2, budget=len(data) * 5 // 2)
+    batches = prefetcher.load()
+    lines = await anext(batches)
+    await asyncio.sleep(0.05)
+    assert (tmp_path / "prefetch-1.ijson").stat().st_size == len(data)
+    next_path = tmp_path / "prefetch-2.ijson"
+    assert not next_path.exists() or next_path.stat().st_size == 0
+    lines.extend([line async for batch in batches for line in batch])
+    assert len(lines) == 3 * len(data.strip().splitlines())
+    assert not len(list(tmp_path.iterdir()))
+
+
+class BrokenStream(httpx.AsyncByteStream):
+    """A response body which fails after sending the given data."""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    async def __aiter__(self):
+        if len(self.data):
+            yield self.data
+        raise httpx.ReadError("Connection reset")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("resume_status", [206, 200])
+async def test_stream_resume(httpx_mock: Any, monkeypatch: Any, resume_status: int):
+    monkeypatch.setattr(settings, "STREAM_LOAD", True)
+    monkeypatch.setattr(loader, "CHUNK_SIZE", 4096)
+    data = Path(__file__).parent.joinpath("fixtures/donations.ijson").read_bytes()
+    expected = [orjson.loads(line) for line in data.strip().splitlines()]
+    url = "https://data.example.com/stream/donations.ijson"
+    # The connection drops in the middle of a line, after 16 chunks:
+    cut = 16 * 4096
+    assert data[cut - 1] != ord("\n")
+    ranges = []
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        ranges.append(request.headers.get("Range"))
+        if len(ranges) == 1:
+            return httpx.Response(200, stream=BrokenStream(data[:cut]))
+        if resume_status == 206:
+            start = int(request.headers["Range"][6:-1])
+            return httpx.Response(206, content=data[start:])
+        return httpx.Response(200, content=data)
+
+    httpx_mock.add_callback(respond, url=url, is_reusable=True)
+    lines = [line async for line in load_json_lines(url, "test")]
+    assert lines == expected
+    offset = data.rindex(b"\n", 0, cut) + 1
+    assert ranges == [None, f"bytes={offset}-"]
+
+
+@pytest.mark.asyncio
+async def test_stream_no_progress(httpx_mock: Any, monkeypatch: Any):
+    monkeypatch.setattr(settings, "STREAM_LOAD", True)
+    url = "https://data.example.com/stream/broken.ijson"
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, stream=BrokenStream(b""))
+
+    httpx_mock.add_callback(respond, url=url, is_reusable=True)
+    with pytest.raises(httpx.ReadError):
+        [line async for line in load_json_lines(url, "test")]
+    assert len(httpx_mock.get_requests()) == 5
+
+
 def test_get_url_local_path():
     out = get_url_local_path("http://banana.com/bla.txt")
     assert out is None
@@ -56,3 +265,130 @@ def test_phonetic_names():
     assert len(phonemes) == 3
     phonemes = phonetic_names(["OAO Gazprom"])
     assert len(phonemes) == 1
+
+
+def test_name_features(tmp_path: Path):
+    names = ["Vladimir Putin", "Влади́мир Влади́мирович ПУ́ТИН", "OAO Gazprom"]
+    parts, keys, phonemes = name_features(names)
+    assert parts == index_name_parts(names)
+    assert phonemes == phonetic_names(names)
+
+    cache = NameFeatureCache(tmp_path / "names.sqlite3", "v1")
+    features = cache.lookup(names)
+    cache.flush()
+    cache = NameFeatureCache(tmp_path / "names.sqlite3", "v1")
+    assert cache.lookup(names) == features
+    assert not len(cache.pending)
+    cache = NameFeatureCache(tmp_path / "names.sqlite3", "v2")
+    assert cache.lookup(names) == features
+    assert len(cache.pending) == len(names)
+
+
+@pytest.mark.asyncio
+async def test_http_cache(httpx_mock: Any, tmp_path: Path, monkeypatch: Any):
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(settings, "HTTP_CACHE", True)
+    url = "https://data.example.com/index.json"
+    headers = {"ETag": '"v1"'}
+    httpx_mock.add_response(200, url=url, json={"datasets": []}, headers=headers)
+    data = await load_json_url(url)
+    assert data == {"datasets": []}
+    digest = get_url_digest(url)
+    assert digest is not None
+
+    httpx_mock.add_response(304, url=url, match_headers={"If-None-Match": '"v1"'})
+    assert await load_json_url(url) is data
+    assert get_url_digest(url) == digest
+
+    # A restarted process reads the cached body from disk:
+    MEMO.pop(url)
+    httpx_mock.add_response(304, url=url, match_headers={"If-None-Match": '"v1"'})
+    assert await load_json_url(url) == data
+    assert get_url_digest(url) == digest
+
+
+@pytest.mark.asyncio
+async def test_write_file_atomic(tmp_path: Path):
+    body_path = tmp_path / "key.body"
+    meta_path = tmp_path / "key.json"
+
+    def write(path: Path, data: bytes) -> None:
+        for _ in range(200):
+            write_file_atomic(path, data)
+
+    await asyncio.gather(
+        asyncio.to_thread(write, body_path, b"body"),
+        asyncio.to_thread(write, meta_path, b"meta"),
+        asyncio.to_thread(write, meta_path, b"meta"),
+    )
+    assert body_path.read_bytes() == b"body"
+    assert meta_path.read_bytes() == b"meta"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["key.body", "key.json"]
+
+
+@pytest.mark.asyncio
+async def test_http_client_pool(httpx_mock: Any):
+    url = "https://data.example.com/pool.json"
+    httpx_mock.add_response(200, url=url, json={}, is_reusable=True)
+    client = get_http_client()
+    assert get_http_client() is client
+    async with httpx_session() as session:
+        assert session is client
+        await session.get(url)
+        await session.get(url)
+    assert not client.is_closed
+    assert get_http_metrics()["requests"] == 2
+    await close_http_client()
+    assert client.is_closed
+    assert get_http_client() is not client
+    await close_http_client()
+
+
+@pytest.mark.asyncio
+async def test_load_yaml_url():
+    url = Path(__file__).parent.joinpath("fixtures/manifest.yml").as_posix()
+    data = await load_yaml_url(url)
+    assert len(data["datasets"]) > 0
+    assert await load_yaml_url(url) is data
+    assert get_url_digest(url) is not None
+
+
+@pytest.mark.asyncio
+async def test_mirror_catalog(httpx_mock: Any, tmp_path: Path, monkeypatch: Any):
+    base = "https://data.example.com/mirrored"
+    manifest = {
+        "datasets": [
+            {
+                "name": "mirrored",
+                "title": "Mirrored dataset",
+                "version": "20240101",
+                "entities_url": f"{base}/entities.ftm.json",
+                "delta_url": f"{base}/delta.json",
+            }
+        ]
+    }
+    manifest_path = tmp_path.joinpath("manifest.yml")
+    manifest_path.write_bytes(orjson.dumps(manifest))
+    monkeypatch.setattr(settings, "MANIFEST", manifest_path.as_posix())
+    entities = Path(__file__).parent.joinpath("fixtures/donations.ijson").read_bytes()
+    deltas = {"versions": {"20240101": f"{base}/20240101.delta.json"}}
+    httpx_mock.add_response(200, url=f"{base}/entities.ftm.json", content=entities)
+    delta_url = f"{base}/delta.json"
+    httpx_mock.add_response(200, url=delta_url, json=deltas, is_reusable=True)
+    httpx_mock.add_response(200, url=f"{base}/20240101.delta.json", content=b"")
+    mirror_path = tmp_path.joinpath("mirror")
+    await mirror_catalog(mirror_path)
+    path = mirror_path.joinpath("mirrored/20240101/entities.ftm.json")
+    assert path.read_bytes() == entities
+    assert mirror_path.joinpath("mirrored/deltas/20240101.delta.json").exists()
+
+    # Files which are already mirrored are not downloaded again:
+    await mirror_catalog(mirror_path)
+
+    MEMO.clear()
+    monkeypatch.setattr(settings, "MANIFEST", f"{mirror_path}/manifest.yml")
+    loaded = await Manifest.load()
+    data = loaded.datasets[0]
+    assert get_url_local_path(data["entities_url"]) == path
+    index = await load_json_url(data["delta_url"])
+    assert get_url_local_path(index["versions"]["20240101"]) is not None
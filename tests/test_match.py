@@ -1,4 +1,16 @@
-from .conftest import client
+import orjson
+import pytest
+from pathlib import Path
+from followthemoney import model
+from nomenklatura.matching import get_algorithm
+
+from yente import settings
+from yente.data.common import EntityExample, ScoredEntityResponse
+from yente.data.entity import Entity
+from yente.scoring import score_results, score_results_async, close_score_executor
+from yente.scoring import compare_batch
+from yente.search import cache
+from .conftest import client, FIXTURES_PATH
 
 EXAMPLE = {
     "schema": "Person",
@@ -159,3 +171,129 @@ def test_id_pass_through():
     res = resp.json()["responses"]["no1"]
     assert res["query"]["schema"] == "Person"
     assert res["query"]["id"] == "ermakov"
+
+
+def test_match_cache(monkeypatch):
+    monkeypatch.setattr(settings, "MATCH_CACHE", True)
+    monkeypatch.setattr(cache, "_cache", None)
+    query = {"queries": {"vv": EXAMPLE}}
+    resp = client.post("/match/default", json=query)
+    assert resp.status_code == 200, resp.text
+    assert resp.headers["x-cache-hits"] == "0"
+
+    body = dict(EXAMPLE)
+    body["id"] = "putin"
+    resp2 = client.post("/match/default", json={"queries": {"vv": body}})
+    assert resp2.headers["x-cache-hits"] == "1"
+    res = resp2.json()["responses"]["vv"]
+    assert res["query"]["id"] == "putin"
+    assert res["results"] == resp.json()["responses"]["vv"]["results"]
+
+    resp = client.post("/match/default", json=query, params={"limit": 3})
+    assert resp.headers["x-cache-hits"] == "0"
+    cache.invalidate_match_cache()
+    resp = client.post("/match/default", json=query)
+    assert resp.headers["x-cache-hits"] == "0"
+
+
+def test_match_adaptive(monkeypatch):
+    query = {"queries": {"vv": EXAMPLE}}
+    params = {"limit": 3}
+    resp = client.post("/match/default", json=query, params=params)
+    assert resp.status_code == 200, resp.text
+    assert "x-match-expansions" not in resp.headers
+    expected = resp.json()["responses"]["vv"]["results"]
+
+    monkeypatch.setattr(settings, "MATCH_ADAPTIVE", True)
+    monkeypatch.setattr(settings, "MATCH_ADAPTIVE_WINDOW", 5)
+    resp = client.post("/match/default", json=query, params=params)
+    assert resp.status_code == 200, resp.text
+    results = resp.json()["responses"]["vv"]["results"]
+    assert results[0]["id"] == expected[0]["id"] == "Q7747"
+
+    # Every candidate is a match, so the window keeps growing:
+    monkeypatch.setattr(settings, "MATCH_ADAPTIVE_WINDOW", 2)
+    params = {"limit": 1, "threshold": 0.0, "cutoff": -1.0}
+    resp = client.post("/match/default", json=query, params=params)
+    assert resp.status_code == 200, resp.text
+    assert int(resp.headers["x-match-expansions"]) >= 1
+    assert resp.json()["responses"]["vv"]["total"]["value"] > 2
+
+    # No candidate is a match, so the first window is all there is:
+    params = {"limit": 1, "threshold": 1.1, "cutoff": 0.0}
+    resp = client.post("/match/default", json=query, params=params)
+    assert resp.status_code == 200, resp.text
+    assert int(resp.headers["x-match-expansions"]) == 0
+    assert resp.json()["responses"]["vv"]["total"]["value"] == 0
+
+
+@pytest.mark.asyncio
+async def test_match_cache_store(tmp_path: Path):
+    entity = Entity.from_example(EntityExample.model_validate(EXAMPLE))
+    result = ScoredEntityResponse.model_validate(
+        {**entity.to_dict(), "id": "x", "score": 0.9, "features": {"name": 0.9}}
+    )
+    path = tmp_path.joinpath("match-cache.sqlite3")
+    first = cache.MatchCache(10, 60, path=path)
+    key = first.make_key(entity, {"indices": ["a"]})
+    assert await first.get(key) is None
+    await first.put(key, (1, [result]))
+    assert await first.get(key) == (1, [result])
+
+    # Other server processes share the store:
+    second = cache.MatchCache(10, 60, path=path)
+    assert await second.get(second.make_key(entity, {"indices": ["a"]})) is not None
+    assert await second.get(second.make_key(entity, {"indices": ["b"]})) is None
+    assert (second.hits, second.misses) == (1, 1)
+
+    # Results of queries which ran while the index was rolled over are dropped:
+    first.invalidate()
+    assert first.make_key(entity, {"indices": ["a"]}) != key
+    await first.put(key, (2, [result]))
+    assert await first.get(key) == (1, [result])
+
+
+@pytest.mark.asyncio
+async def test_score_executors(monkeypatch):
+    path = FIXTURES_PATH / "dataset/t1/entities.ftm.json"
+    candidates = [Entity.from_dict(model, orjson.loads(line)) for line in path.open()]
+    example = {
+        "schema": "Person",
+        "properties": {"name": ["Vitaly Kuzmenko"], "birthDate": ["1971-01-22"]},
+    }
+    entity = Entity.from_example(EntityExample.model_validate(example))
+    algorithm = get_algorithm("logic-v1")
+    expected = score_results(algorithm, entity, candidates, cutoff=-1)
+    assert len(expected[1]) == len(candidates)
+    assert expected[0] == 1
+    for executor in ("inline", "thread", "process"):
+        monkeypatch.setattr(settings, "SCORE_EXECUTOR", executor)
+        monkeypatch.setattr(settings, "SCORE_WORKERS", 2)
+        try:
+            scored = await score_results_async(algorithm, entity, candidates, cutoff=-1)
+            assert scored == expected
+        finally:
+            close_score_executor()
+
+
+def test_compare_batch(monkeypatch):
+    pytest.importorskip("numpy")
+    path = FIXTURES_PATH / "dataset/t1/entities.ftm.json"
+    candidates = [Entity.from_dict(model, orjson.loads(line)) for line in path.open()]
+    example = {
+        "schema": "Person",
+        "properties": {"name": ["Vitaly Kuzmenko"], "birthDate": ["1971-01-22"]},
+    }
+    entity = Entity.from_example(EntityExample.model_validate(example))
+    overrides = [{}, {"name_literal_match": 0.0, "dob_year_disjoint": 0.3}]
+    for name in ("logic-v1", "name-based", "name-qualified", "regression-v1"):
+        algorithm = get_algorithm(name)
+        for weights in overrides:
+            expected = [algorithm.compare(entity, c, weights) for c in candidates]
+            assert compare_batch(algorithm, entity, candidates, weights) == expected
+    assert compare_batch(algorithm, entity, []) == []
+
+    algorithm = get_algorithm("logic-v1")
+    expected = score_results(algorithm, entity, candidates, cutoff=-1)
+    monkeypatch.setattr(settings, "SCORE_BATCH", True)
+    assert score_results(algorithm, entity, candidates, cutoff=-1) == expected
@@ -1,9 +1,15 @@
 # mypy: ignore-errors
+import json
+import asyncio
 import pytest
 from yente import settings
 
+from yente.data import get_catalog
 from yente.exc import YenteIndexError, YenteNotFoundError
 from yente.provider import SearchProvider
+from yente.provider.bulk import bulk_pipeline
+from yente.search.search import search_entities, search_entities_batch
+from yente.search.warmup import percentile, warmup_index, run_warmup_round
 
 
 @pytest.mark.asyncio
@@ -78,3 +84,154 @@ async def test_alias_management(search_provider: SearchProvider):
     await search_provider.delete_index(index_v2)
     assert not await search_provider.exists_index_alias(alias, index_v2)
     assert await search_provider.get_alias_indices(alias) == []
+
+
+@pytest.mark.asyncio
+async def test_index_build_profile(search_provider: SearchProvider):
+    temp_index = settings.ENTITY_INDEX + "-provider-build"
+    await search_provider.create_index(temp_index, build=True)
+    await search_provider.finalize_index(temp_index, force_merge=True)
+    assert await search_provider.check_health(temp_index) is True
+    await search_provider.delete_index(temp_index)
+
+
+@pytest.mark.asyncio
+async def test_index_warmup(search_provider: SearchProvider, tmp_path):
+    catalog = await get_catalog()
+    dataset = catalog.require("default")
+    index = settings.ENTITY_INDEX
+    latencies = await warmup_index(search_provider, dataset, index)
+    assert len(latencies) > 0
+    assert percentile(latencies, 50) <= percentile(latencies, 95)
+
+    queries_path = tmp_path / "queries.json"
+    with open(queries_path, "w") as fh:
+        fh.write('{"schema": "Person", "properties": {"name": ["Vladimir Putin"]}}\n')
+        fh.write('{"q": "putin"}\n')
+    settings.INDEX_WARMUP_QUERIES = queries_path.as_posix()
+    try:
+        latencies = await warmup_index(search_provider, dataset, index)
+        assert len(latencies) == 2
+    finally:
+        settings.INDEX_WARMUP_QUERIES = None
+
+
+class WarmupProvider(SearchProvider):
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self.throttled = 0
+
+    async def search(self, index, query, throttle=True, **kwargs):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        self.throttled += int(throttle)
+        await asyncio.sleep(0.001)
+        self.active -= 1
+        return {}
+
+
+def test_warmup_round_concurrency():
+    # The warm-up runs on the event loop of the update thread, so it must not
+    # use the query semaphore of the API server:
+    provider = WarmupProvider()
+
+    async def warmup():
+        semaphore = asyncio.Semaphore(3)
+        queries = [{"match_all": {}} for _ in range(50)]
+        return await run_warmup_round(provider, "index", queries, semaphore)
+
+    latencies = asyncio.run(warmup())
+    assert len(latencies) == 50
+    assert provider.peak == 3
+    assert provider.throttled == 0
+
+
+@pytest.mark.asyncio
+async def test_msearch(search_provider: SearchProvider, monkeypatch):
+    monkeypatch.setattr(settings, "QUERY_BATCH_SIZE", 2)
+    names = ["Vladimir Putin", "Hamas", "Nobody Atall", "Putin"]
+    queries = [{"match": {"names": name}} for name in names]
+    responses = await search_entities_batch(search_provider, queries, [3] * 4)
+    assert len(responses) == len(queries)
+    for query, response in zip(queries, responses):
+        single = await search_entities(search_provider, query, limit=3)
+        hits = [h["_id"] for h in response["hits"]["hits"]]
+        assert hits == [h["_id"] for h in single["hits"]["hits"]]
+    assert await search_entities_batch(search_provider, [], []) == []
+
+    fake_index = settings.ENTITY_INDEX + "-doesnt-exist"
+    with pytest.raises(YenteIndexError):
+        await search_provider.msearch(fake_index, [{"query": queries[0]}])
+
+
+@pytest.mark.asyncio
+async def test_bulk_pipeline(monkeypatch):
+    monkeypatch.setattr(settings, "INDEX_BULK_BYTES", 300)
+    monkeypatch.setattr(settings, "INDEX_BULK_CONCURRENCY", 3)
+    actions = []
+    for i in range(24):
+        source = {"caption": f"Entity {i}", "n": i}
+        actions.append({"_index": "test", "_id": f"e{i % 12}", "_source": source})
+    actions.append({"_index": "test", "_id": "e2", "_op_type": "delete"})
+
+    async def generate():
+        for action in actions:
+            yield action
+
+    docs = {}
+    sent = []
+    chunks = []
+    rejected = set()
+    active = 0
+    peak = 0
+
+    async def send(body):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        lines = [json.loads(line) for line in body.splitlines()]
+        first = len(sent) == 0
+        items = []
+        ops = []
+        while len(lines):
+            meta = lines.pop(0)
+            op, info = next(iter(meta.items()))
+            source = lines.pop(0) if op != "delete" else None
+            ops.append((op, info["_id"], source))
+        sent.append(len(body.encode("utf-8")))
+        if not all(id_ in rejected for _, id_, _ in ops):
+            chunks.append(len(ops))
+        # Make the first chunk finish last:
+        await asyncio.sleep(0.05 if first else 0.01)
+        for op, id_, source in ops:
+            if id_ == "e5" and id_ not in rejected:
+                rejected.add(id_)
+                items.append({op: {"status": 429}})
+                continue
+            if op == "delete":
+                docs.pop(id_, None)
+            else:
+                docs[id_] = source
+            items.append({op: {"status": 200}})
+        active -= 1
+        errors = any(i[op]["status"] != 200 for i in items for op in i)
+        return {"errors": errors, "items": items}
+
+    acks = []
+    await bulk_pipeline(generate(), send, on_ack=acks.append)
+    # Chunks are cut by size, not by the number of actions:
+    assert len(acks) > 1
+    assert all(size < 300 + 100 for size in sent)
+    assert 1 < peak <= 3
+    # All actions are acknowledged once, in the order of their chunks, even though
+    # the first chunk finished last:
+    assert acks == chunks
+    assert sum(acks) == len(actions)
+    # Later actions on an entity are applied after the earlier ones:
+    assert "e2" not in docs
+    for i in range(12, 24):
+        if i % 12 != 2:
+            assert docs[f"e{i % 12}"]["n"] == i
+    # Rejected actions are retried:
+    assert rejected == {"e5"}
@@ -1,11 +1,26 @@
 import re
+import gzip
 import json
+import asyncio
 import pytest
 from .conftest import FIXTURES_PATH
-from typing import List, Any
+from pathlib import Path
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Any, Optional
 
+from yente import settings
 from yente.data import get_catalog, refresh_catalog
-from yente.data.updater import DatasetUpdater
+from yente.data.dataset import Dataset
+from yente.data.manifest import Catalog
+from yente.data.updater import DatasetUpdater, EntityOp
+from yente.exc import YenteIndexError
+from yente.provider import SearchProvider
+from yente.provider.bulk import BulkAck, bulk_pipeline
+from yente.search.bundle import load_bundle, read_bundle_header, write_bundle
+from yente.search.checkpoint import IndexCheckpoint
+from yente.search import indexer
+from yente.search.indexer import delete_old_indices, index_entities, iter_entity_docs
+from yente.search.pipeline import Pipeline
 
 
 @pytest.fixture
@@ -89,3 +104,340 @@ async def test_updater(httpx_mock: Any, sanctions_catalog: None) -> None:
     assert ops["ADD"] == 4
     assert ops["DEL"] == 1
     assert ops["MOD"] == 1
+
+
+@pytest.mark.asyncio
+async def test_updater_synthesized_deltas(tmp_path: Path, monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(settings, "DELTA_SYNTHESIZE", True)
+    entities = [
+        json.loads(line)
+        for line in (FIXTURES_PATH / "dataset/t1/entities.ftm.json").open()
+    ]
+    export_path = tmp_path / "entities.ftm.json"
+
+    def make_dataset(version: str, entities: List[Dict[str, Any]]) -> Dataset:
+        with open(export_path, "w") as fh:
+            for entity in entities:
+                fh.write(json.dumps(entity) + "\n")
+        data = {"name": "synth", "title": "Synth", "version": version}
+        data["path"] = export_path.as_posix()
+        return Dataset(data)
+
+    dataset = make_dataset("1", entities)
+    updater = await DatasetUpdater.build(dataset, None)
+    assert not updater.is_incremental
+    operations = [x async for x in updater.load()]
+    assert len(operations) == len(entities)
+
+    changed = dict(entities[1])
+    changed["properties"] = {**changed["properties"], "notes": ["Changed"]}
+    removed = entities[2]
+    entities = [entities[0], changed] + entities[3:] + [{**removed, "id": "new"}]
+    dataset = make_dataset("2", entities)
+    updater = await DatasetUpdater.build(dataset, "1")
+    assert updater.is_incremental
+    assert updater.needs_update()
+    operations = [x async for x in updater.load()]
+    ops = {op["entity"]["id"]: op["op"] for op in operations}
+    assert ops == {changed["id"]: "MOD", "new": "ADD", removed["id"]: "DEL"}
+
+
+@pytest.mark.asyncio
+async def test_updater_coalesce_ops(tmp_path: Path, monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    entities_path = FIXTURES_PATH / "dataset/t1/entities.ftm.json"
+    data = {"name": "coalesce", "title": "Coalesce", "version": "20240528134729-3iv"}
+    data["path"] = entities_path.as_posix()
+    dataset = Dataset(data)
+    updater = DatasetUpdater(dataset, "20240527134702-zbn")
+    updater.delta_urls = []
+    for path in sorted((FIXTURES_PATH / "dataset/t2").glob("*/entities.delta.json")):
+        updater.delta_urls.append((path.parent.name, path.as_posix()))
+        updater.delta_urls.append((path.parent.name, path.as_posix()))
+
+    monkeypatch.setattr(settings, "DELTA_COALESCE", False)
+    expected = {op["entity"]["id"]: op async for op in updater.load()}
+    for buffer in (2, 1000):
+        monkeypatch.setattr(settings, "DELTA_COALESCE", True)
+        monkeypatch.setattr(settings, "DELTA_COALESCE_BUFFER", buffer)
+        operations = [op async for op in updater.load()]
+        assert len(operations) == len(expected)
+        assert {op["entity"]["id"]: op for op in operations} == expected
+    assert not len(list(tmp_path.iterdir()))
+
+
+@pytest.mark.asyncio
+async def test_updater_prefetch_deltas(
+    httpx_mock: Any, tmp_path: Path, monkeypatch: Any
+) -> None:
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    data = {"name": "prefetch", "title": "Prefetch", "version": "20240528134729-3iv"}
+    data["path"] = (FIXTURES_PATH / "dataset/t1/entities.ftm.json").as_posix()
+    dataset = Dataset(data)
+    updater = DatasetUpdater(dataset, "20240527134702-zbn")
+    updater.delta_urls = []
+    for path in sorted((FIXTURES_PATH / "dataset/t2").glob("*/entities.delta.json")):
+        url = f"https://data.example.com/{path.parent.name}/entities.delta.json"
+        updater.delta_urls.append((path.parent.name, url))
+        httpx_mock.add_response(url=url, content=path.read_bytes(), is_reusable=True)
+
+    expected = [op async for op in updater.load()]
+    assert len(expected) > 0
+    monkeypatch.setattr(settings, "DELTA_PREFETCH", 2)
+    assert [op async for op in updater.load()] == expected
+    # With no disk budget, the files are fetched one at a time:
+    monkeypatch.setattr(settings, "DELTA_PREFETCH_BYTES", 0)
+    assert [op async for op in updater.load()] == expected
+    assert not len(list(tmp_path.iterdir()))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("processes", [0, 2])
+async def test_iter_entity_docs(monkeypatch: Any, processes: int) -> None:
+    monkeypatch.setattr(settings, "INDEX_PROCESSES", processes)
+    monkeypatch.setattr(settings, "INDEX_CHUNK_SIZE", 2)
+    monkeypatch.setattr(settings, "INDEX_QUEUE_SIZE", 1)
+    entities_path = FIXTURES_PATH / "dataset/t1/entities.ftm.json"
+    data = {"name": "pipeline", "title": "Pipeline", "version": "1"}
+    data["path"] = entities_path.as_posix()
+    updater = DatasetUpdater(Dataset(data), None, force_full=True)
+    actions = [a async for a in iter_entity_docs(updater, "test-index")]
+    ids = [json.loads(line)["id"] for line in entities_path.open()]
+    assert [a["_id"] for a in actions] == ids
+    assert all(a["_index"] == "test-index" for a in actions)
+
+    async def failing_load() -> AsyncGenerator[EntityOp, None]:
+        async for op in DatasetUpdater.load(updater):
+            yield op
+        raise RuntimeError("Download failed")
+
+    monkeypatch.setattr(updater, "load", failing_load)
+    with pytest.raises(RuntimeError):
+        async for _ in iter_entity_docs(updater, "test-index"):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_pipeline_pending_items() -> None:
+    loop = asyncio.get_running_loop()
+    async with Pipeline("test") as pipeline:
+        build = pipeline.stage("build", 4)
+
+        async def produce() -> None:
+            for value in range(3):
+                future: asyncio.Future[int] = loop.create_future()
+                loop.call_later(0.05, future.set_result, value)
+                future.add_done_callback(lambda _: build.count(1))
+                await build.put(future, 0)
+            assert build.items == 0
+
+        pipeline.start(build, produce())
+        sink = pipeline.stage("sink")
+        values = [await sink.wait(future) async for future in sink.inputs()]
+    assert values == [0, 1, 2]
+    assert build.items == 3
+    # Waiting on the pending items counts as starved, not as busy:
+    assert sink.starved >= 0.04
+    assert build.blocked < 0.04
+
+
+class MemoryProvider(SearchProvider):
+    """A search provider which keeps the indexed documents in memory, and can be
+    made to fail after a given number of bulk actions."""
+
+    def __init__(self, fail_after: Optional[int] = None) -> None:
+        self.indices: Dict[str, Dict[str, Any]] = {}
+        self.aliases: List[str] = []
+        self.created: List[str] = []
+        self.fail_after = fail_after
+        self.sent = 0
+
+    async def get_all_indices(self) -> List[str]:
+        return list(self.indices.keys())
+
+    async def get_alias_indices(self, alias: str) -> List[str]:
+        return list(self.aliases)
+
+    async def exists_index_alias(self, alias: str, index: str) -> bool:
+        return index in self.aliases
+
+    async def create_index(self, index: str, build: bool = False) -> None:
+        self.created.append(index)
+        self.indices[index] = {}
+
+    async def delete_index(self, index: str) -> None:
+        self.indices.pop(index, None)
+
+    async def refresh(self, index: str) -> None:
+        pass
+
+    async def finalize_index(self, index: str, force_merge: bool = False) -> None:
+        pass
+
+    async def rollover_index(self, alias: str, next_index: str, prefix: str) -> None:
+        self.aliases = [i for i in self.aliases if not i.startswith(prefix)]
+        self.aliases.append(next_index)
+
+    async def send(self, body: str) -> Dict[str, Any]:
+        lines = [json.loads(line) for line in body.splitlines()]
+        items = []
+        for meta, source in zip(lines[::2], lines[1::2]):
+            if self.fail_after is not None and self.sent >= self.fail_after:
+                raise YenteIndexError("Index went away")
+            self.sent += 1
+            action = meta["index"]
+            self.indices[action["_index"]][action["_id"]] = source
+            items.append({"index": {"status": 201}})
+        return {"errors": False, "items": items}
+
+    async def bulk_index(
+        self,
+        entities: AsyncIterator[Dict[str, Any]],
+        on_ack: Optional[BulkAck] = None,
+    ) -> None:
+        await bulk_pipeline(entities, self.send, 1, 1, on_ack=on_ack)
+
+
+@pytest.mark.asyncio
+async def test_index_checkpoint_resume(monkeypatch: Any, tmp_path: Path) -> None:
+    monkeypatch.setattr(settings, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(settings, "INDEX_CHECKPOINTS", True)
+    monkeypatch.setattr(settings, "INDEX_WARMUP", False)
+    monkeypatch.setattr(settings, "INDEX_CHUNK_SIZE", 2)
+    entities_path = FIXTURES_PATH / "dataset/t1/entities.ftm.json"
+    ids = [json.loads(line)["id"] for line in entities_path.open()]
+    data = {"name": "resume", "title": "Resume", "version": "1"}
+    data["path"] = entities_path.as_posix()
+    catalog = Catalog(Dataset, {})
+    dataset = catalog.make_dataset(data)
+
+    # The index goes away while the fourth entity is being indexed:
+    provider = MemoryProvider(fail_after=3)
+    with pytest.raises(YenteIndexError):
+        await index_entities(provider, dataset, force=False)
+    assert len(provider.created) == 1
+    index = provider.created[0]
+    assert list(provider.indices[index].keys()) == ids[:3]
+    assert provider.aliases == []
+    checkpoint = IndexCheckpoint.load(index, None, False)
+    assert checkpoint.offset == 3
+    assert checkpoint.path.exists()
+
+    # The resumed build keeps the partial index and only sends the rest:
+    provider.fail_after = None
+    provider.sent = 0
+    await index_entities(provider, dataset, force=False)
+    assert provider.created == [index]
+    assert provider.sent == len(ids) - 3
+    assert sorted(provider.indices[index].keys()) == sorted(ids)
+    assert provider.aliases == [index]
+    assert not checkpoint.path.exists()
+
+    # Checkpoints of builds which were never completed are removed:
+    stale = IndexCheckpoint("yente-entities-gone-1", None, False, offset=5)
+    stale.save()
+    await delete_old_indices(provider, catalog)
+    assert not stale.path.exists()
+
+
+class RecordingLog(object):
+    def __init__(self) -> None:
+        self.errors: List[Dict[str, Any]] = []
+
+    def info(self, msg: str, **kwargs: Any) -> None:
+        pass
+
+    def exception(self, msg: str, **kwargs: Any) -> None:
+        self.errors.append(kwargs)
+
+
+@pytest.mark.asyncio
+async def test_update_index_failures(monkeypatch: Any) -> None:
+    catalog = Catalog(Dataset, {})
+    for name in ("first", "second", "third"):
+        catalog.make_dataset({"name": name, "title": name})
+    provider = MemoryProvider()
+    indexed: List[str] = []
+
+    @asynccontextmanager
+    async def with_provider() -> AsyncIterator[MemoryProvider]:
+        yield provider
+
+    async def get_catalog() -> Catalog:
+        return catalog
+
+    async def index_entities_locked(
+        provider: SearchProvider, dataset: Dataset, *args: Any
+    ) -> None:
+        if dataset.name == "first":
+            raise YenteIndexError("Index is gone")
+        if dataset.name == "third":
+            raise RuntimeError("Download failed")
+        indexed.append(dataset.name)
+
+    log = RecordingLog()
+    monkeypatch.setattr(indexer, "log", log)
+    monkeypatch.setattr(indexer, "with_provider", with_provider)
+    monkeypatch.setattr(indexer, "get_catalog", get_catalog)
+    monkeypatch.setattr(indexer, "index_entities_locked", index_entities_locked)
+    with pytest.raises(YenteIndexError):
+        await indexer.update_index()
+    assert indexed == ["second"]
+    assert [e["dataset"] for e in log.errors] == ["first", "third"]
+    assert isinstance(log.errors[1]["exc_info"], RuntimeError)
+
+
+@pytest.mark.asyncio
+async def test_bundle_roundtrip(monkeypatch: Any, tmp_path: Path) -> None:
+    monkeypatch.setattr(settings, "INDEX_BUILD_PROFILE", False)
+    entities_path = FIXTURES_PATH / "dataset/t1/entities.ftm.json"
+    ids = [json.loads(line)["id"] for line in entities_path.open()]
+    data = {"name": "bundled", "title": "Bundled", "version": "1"}
+    data["path"] = entities_path.as_posix()
+    catalog = Catalog(Dataset, {})
+    dataset = catalog.make_dataset(data)
+    path = tmp_path / "bundled.ndjson.gz"
+    await write_bundle(dataset, path)
+    with gzip.open(path, "rb") as fh:
+        header = read_bundle_header(fh)
+    assert header["dataset"] == "bundled"
+
+    provider = MemoryProvider()
+    await load_bundle(provider, path, catalog)
+    assert len(provider.aliases) == 1
+    index = provider.aliases[0]
+    assert sorted(provider.indices[index].keys()) == sorted(ids)
+    # Loading the same bundle again is a no-op:
+    await load_bundle(provider, path, catalog)
+    assert provider.created == [index]
+
+    # Bundles older than the index, or of another version than the catalog lists,
+    # are only loaded when forced:
+    bundles: Dict[str, Path] = {}
+    for version in ("0", "2"):
+        other = Catalog(Dataset, {}).make_dataset({**data, "version": version})
+        bundles[version] = tmp_path / f"bundled-{version}.ndjson.gz"
+        await write_bundle(other, bundles[version])
+    with pytest.raises(ValueError, match="older than"):
+        await load_bundle(provider, bundles["0"], catalog)
+    with pytest.raises(ValueError, match="catalog version"):
+        await load_bundle(provider, bundles["2"], catalog)
+    assert provider.aliases == [index]
+    await load_bundle(provider, bundles["2"], catalog, force=True)
+    assert len(provider.created) == 2
+    assert provider.aliases == [provider.created[1]]
+
+    # Bundles of datasets which are not loaded are rejected:
+    with pytest.raises(ValueError):
+        await load_bundle(provider, path, Catalog(Dataset, {}))
+
+    # Bundles built for another system version are rejected:
+    with gzip.open(path, "rb") as fh:
+        lines = fh.readlines()
+    header["system_version"] = "0"
+    lines[0] = json.dumps(header).encode("utf-8") + b"\n"
+    with gzip.open(path, "wb") as fh:
+        fh.writelines(lines)
+    with pytest.raises(ValueError):
+        await load_bundle(provider, path, catalog)
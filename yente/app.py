@@ -19,6 +19,8 @@ from yente.routers import reconcile, search, match, admin
 from yente.data import refresh_catalog
 from yente.search.indexer import update_index_threaded
 from yente.provider import close_provider
+from yente.data.util import close_http_client
+from yente.scoring import close_score_executor
 from yente.middleware import TraceContextMiddleware
 
 log = get_logger("yente")
@@ -43,6 +45,8 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
         update_index_threaded()
     yield
     await close_provider()
+    await close_http_client()
+    close_score_executor()
 
 
 async def request_middleware(
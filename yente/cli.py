@@ -1,11 +1,17 @@
 import click
 import asyncio
+from pathlib import Path
+from typing import Optional
 from uvicorn import Config, Server
 
 from yente import settings
 from yente.app import create_app
 from yente.logs import configure_logging, get_logger
+from yente.data import get_catalog
+from yente.data.util import close_http_client
+from yente.data.mirror import mirror_catalog
 from yente.search.indexer import update_index
+from yente.search.bundle import write_bundle, load_bundle
 from yente.provider import with_provider
 
 
@@ -37,11 +43,77 @@ def serve() -> None:
     server.run()
 
 
+async def _reindex(force: bool) -> None:
+    try:
+        await update_index(force=force)
+    finally:
+        await close_http_client()
+
+
 @cli.command("reindex", help="Re-index the data if newer data is available")
 @click.option("-f", "--force", is_flag=True, default=False)
 def reindex(force: bool) -> None:
     configure_logging()
-    asyncio.run(update_index(force=force))
+    asyncio.run(_reindex(force))
+
+
+async def _build_docs(dataset_name: str, path: Path) -> None:
+    try:
+        catalog = await get_catalog()
+        dataset = catalog.get(dataset_name)
+        if dataset is None:
+            raise click.BadParameter(f"No such dataset: {dataset_name}")
+        await write_bundle(dataset, path)
+    finally:
+        await close_http_client()
+
+
+@cli.command("build-docs", help="Write the index documents of a dataset to a bundle")
+@click.argument("dataset", type=str)
+@click.argument("outfile", type=click.Path(dir_okay=False, writable=True))
+def build_docs(dataset: str, outfile: str) -> None:
+    configure_logging()
+    asyncio.run(_build_docs(dataset, Path(outfile)))
+
+
+async def _load_docs(path: Path, force: bool) -> None:
+    try:
+        catalog = await get_catalog()
+        async with with_provider() as provider:
+            await load_bundle(provider, path, catalog, force=force)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+    finally:
+        await close_http_client()
+
+
+@cli.command("load-docs", help="Load a bundle of index documents into the index")
+@click.argument("bundle", type=click.Path(exists=True, dir_okay=False))
+@click.option("-f", "--force", is_flag=True, default=False)
+def load_docs(bundle: str, force: bool) -> None:
+    configure_logging()
+    asyncio.run(_load_docs(Path(bundle), force))
+
+
+async def _mirror(path: Path, base_url: Optional[str]) -> None:
+    try:
+        await mirror_catalog(path, base_url=base_url)
+    finally:
+        await close_http_client()
+
+
+@cli.command("mirror", help="Download the data into a directory for offline use")
+@click.argument("outdir", type=click.Path(file_okay=False, writable=True))
+@click.option(
+    "-u",
+    "--base-url",
+    type=str,
+    default=None,
+    help="URL of the directory as seen by the yente nodes using it",
+)
+def mirror(outdir: str, base_url: Optional[str]) -> None:
+    configure_logging()
+    asyncio.run(_mirror(Path(outdir), base_url))
 
 
 async def _clear_index() -> None:
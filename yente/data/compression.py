@@ -0,0 +1,79 @@
+import bz2
+import zlib
+import lzma
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+# File name extensions of compressed data files:
+EXTENSIONS: Dict[str, str] = {
+    ".gz": "gzip",
+    ".gzip": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".lzma": "xz",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+}
+# HTTP Content-Encoding values which are decompressed by yente itself, rather than
+# by the HTTP client:
+ENCODINGS: Dict[str, str] = {
+    "gzip": "gzip",
+    "x-gzip": "gzip",
+    "bzip2": "bz2",
+    "xz": "xz",
+    "zstd": "zstd",
+}
+
+
+def get_compression(name: str, encoding: Optional[str] = None) -> Optional[str]:
+    """Determine the compression of a data file from its file name or URL, or
+    from the Content-Encoding it was served with."""
+    path = urlparse(name).path.lower()
+    for extension, compression in EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    if encoding is not None:
+        return ENCODINGS.get(encoding.strip().lower())
+    return None
+
+
+class Decompressor(object):
+    """Incrementally decompress a data stream. Streams made up of several
+    concatenated compressed members (e.g. from `pigz`) are supported."""
+
+    def __init__(self, compression: str) -> None:
+        self.compression = compression
+        self.obj = self._make()
+        self.partial = False
+
+    def _make(self) -> Any:
+        if self.compression == "gzip":
+            return zlib.decompressobj(wbits=31)
+        if self.compression == "bz2":
+            return bz2.BZ2Decompressor()
+        if self.compression == "xz":
+            return lzma.LZMADecompressor()
+        if self.compression == "zstd":
+            try:
+                import zstandard
+            except ImportError as exc:
+                msg = "Reading zstd-compressed data requires the `zstandard` package."
+                raise RuntimeError(msg) from exc
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError("Unknown compression: %s" % self.compression)
+
+    def decompress(self, data: bytes) -> bytes:
+        blocks: List[bytes] = []
+        while len(data):
+            blocks.append(self.obj.decompress(data))
+            self.partial = not self.obj.eof
+            if self.partial:
+                break
+            data = self.obj.unused_data
+            self.obj = self._make()
+        return b"".join(blocks)
+
+    def finish(self) -> None:
+        """Check that the stream did not end in the middle of a compressed member."""
+        if self.partial:
+            raise RuntimeError("Compressed data is truncated (%s)" % self.compression)
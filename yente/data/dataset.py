@@ -26,6 +26,12 @@ class Dataset(NKDataset):
         super().__init__(data)
         self.load = as_bool(data.get("load"), not self.is_collection)
         self.entities_url = self._get_entities_url(data)
+        self.entities_checksum: Optional[str] = None
+        self.entities_size: Optional[int] = None
+        for resource in self.resources:
+            if resource.url is not None and resource.url == self.entities_url:
+                self.entities_checksum = resource.checksum
+                self.entities_size = resource.size
         if self.entities_url is not None:
             entities_path = get_url_local_path(self.entities_url)
             if entities_path is not None:
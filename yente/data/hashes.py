@@ -0,0 +1,95 @@
+import orjson
+import sqlite3
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, Generator, Optional
+
+from yente import settings
+from yente.logs import get_logger
+
+log = get_logger(__name__)
+
+
+def hash_entity(data: Dict[str, Any]) -> bytes:
+    """Generate a compact fingerprint of the contents of an entity."""
+    encoded = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha1(encoded).digest()[:12]
+
+
+def get_hashes_path(dataset: str, version: str) -> Path:
+    return settings.DATA_PATH.joinpath("hashes", f"{dataset}-{version}.sqlite3")
+
+
+class EntityHashes(object):
+    """A table of entity IDs and content hashes for a version of a dataset. This is
+    used to synthesize delta updates for datasets which do not publish them: the
+    entities of a new export are compared against the hashes recorded when the
+    previous version was indexed."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entities (id TEXT PRIMARY KEY, hash BLOB)"
+        )
+
+    @classmethod
+    def open(cls, dataset: str, version: str) -> Optional["EntityHashes"]:
+        """Open the hashes recorded for a dataset version, if they exist."""
+        path = get_hashes_path(dataset, version)
+        if not path.exists():
+            return None
+        return cls(path)
+
+    @classmethod
+    def create(cls, dataset: str, version: str) -> "EntityHashes":
+        """Start recording the hashes for a dataset version. They only replace any
+        existing hashes for that version once `commit` is called."""
+        path = get_hashes_path(dataset, version)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.unlink(missing_ok=True)
+        return cls(tmp_path)
+
+    def get(self, entity_id: str) -> Optional[bytes]:
+        sql = "SELECT hash FROM entities WHERE id = ?"
+        row = self.conn.execute(sql, (entity_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, entity_id: str, digest: bytes) -> None:
+        sql = "INSERT OR REPLACE INTO entities (id, hash) VALUES (?, ?)"
+        self.conn.execute(sql, (entity_id, digest))
+
+    def missing_from(self, other: "EntityHashes") -> Generator[str, None, None]:
+        """Get the IDs of all entities in this table which are not in `other`."""
+        self.conn.commit()
+        other.conn.commit()
+        self.conn.execute("ATTACH DATABASE ? AS other", (other.path.as_posix(),))
+        try:
+            sql = (
+                "SELECT id FROM entities WHERE id NOT IN "
+                "(SELECT id FROM other.entities)"
+            )
+            for (entity_id,) in self.conn.execute(sql).fetchall():
+                yield entity_id
+        finally:
+            self.conn.execute("DETACH DATABASE other")
+
+    def commit(self, dataset: str, version: str, keep: Optional[str]) -> None:
+        """Store the hashes as the record of the given dataset version, and remove
+        those of other versions except for `keep`."""
+        self.conn.commit()
+        self.conn.close()
+        path = get_hashes_path(dataset, version)
+        self.path.replace(path)
+        self.path = path
+        keep_names = {path.name}
+        if keep is not None:
+            keep_names.add(get_hashes_path(dataset, keep).name)
+        for other in path.parent.glob(f"{dataset}-*.sqlite3"):
+            if other.name not in keep_names:
+                log.info("Removing outdated entity hashes", path=other.as_posix())
+                other.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        self.conn.close()
@@ -1,94 +1,593 @@
+import os
 import yaml
 import httpx
 import orjson
 import asyncio
+import hashlib
 import aiofiles
 from pathlib import Path
 from itertools import count
-from typing import Any, AsyncGenerator
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, BinaryIO, Callable
+from typing import Deque
+from typing import Dict, List, Set
+from typing import Optional, Tuple, TypeVar
 
 from yente import settings
+from yente.exc import DataIntegrityError
 from yente.logs import get_logger
-from yente.data.util import get_url_local_path, httpx_session
+from yente.data.util import get_url_local_path, httpx_session, segment_session
+from yente.data.util import write_file_atomic
+from yente.data.compression import ENCODINGS, Decompressor, get_compression
 
 log = get_logger(__name__)
+T = TypeVar("T")
+# Use the much faster libyaml parser if PyYAML was built with it:
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+BLOCK_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
 
 
-async def load_yaml_url(url: str) -> Any:
-    if url.lower().endswith(".json"):
-        return await load_json_url(url)
-    path = get_url_local_path(url)
-    if path is not None:
-        async with aiofiles.open(path, "r") as fh:
-            data = await fh.read()
-    else:
-        async with httpx_session() as client:
-            resp = await client.get(url)
-            data = resp.text
-    return yaml.safe_load(data)
+# Parsed metadata files by URL, with a digest of the content they were parsed from:
+MEMO: Dict[str, Tuple[str, Any]] = {}
 
 
-async def load_json_url(url: str) -> Any:
+def get_cache_path(url: str) -> Path:
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return settings.DATA_PATH.joinpath("http-cache", key)
+
+
+async def fetch_url_cached(url: str) -> Tuple[str, Optional[bytes]]:
+    """Fetch a URL and return a digest of its content, along with the content. With
+    the HTTP cache enabled, responses are stored in DATA_PATH along with their ETag
+    and Last-Modified headers, which make the next request for the URL conditional.
+    If the server reports the content as unchanged, no content is returned."""
+    cache_path = get_cache_path(url)
+    meta_path = cache_path.with_suffix(".json")
+    body_path = cache_path.with_suffix(".body")
+    meta: Dict[str, Any] = {}
+    if settings.HTTP_CACHE and meta_path.exists() and body_path.exists():
+        meta = orjson.loads(meta_path.read_bytes())
+    headers = {}
+    if meta.get("etag") is not None:
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified") is not None:
+        headers["If-Modified-Since"] = meta["last_modified"]
+    async with httpx_session() as client:
+        resp = await client.get(url, headers=headers)
+    if resp.status_code == 304 and len(meta):
+        log.debug("Remote file is unchanged", url=url)
+        return meta["digest"], None
+    resp.raise_for_status()
+    content = resp.content
+    digest = hashlib.sha1(content).hexdigest()
+    etag = resp.headers.get("etag")
+    last_modified = resp.headers.get("last-modified")
+    if settings.HTTP_CACHE and (etag is not None or last_modified is not None):
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_file_atomic(body_path, content)
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "digest": digest,
+        }
+        write_file_atomic(meta_path, orjson.dumps(meta))
+    return digest, content
+
+
+async def load_url_cached(url: str, parse: Callable[[bytes], Any]) -> Any:
+    """Load and parse a metadata file, unless the same content has been parsed
+    before. The parsed data is shared between callers and must not be modified."""
     path = get_url_local_path(url)
+    content: Optional[bytes] = None
     if path is not None:
         async with aiofiles.open(path, "rb") as fh:
-            data = await fh.read()
+            content = await fh.read()
+        digest = hashlib.sha1(content).hexdigest()
     else:
-        async with httpx_session() as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            data = resp.content
-    return orjson.loads(data)
+        digest, content = await fetch_url_cached(url)
+    memo = MEMO.get(url)
+    if memo is not None and memo[0] == digest:
+        return memo[1]
+    if content is None:
+        body_path = get_cache_path(url).with_suffix(".body")
+        async with aiofiles.open(body_path, "rb") as fh:
+            content = await fh.read()
+    # Parsing large catalogs takes a while, so keep it off the event loop:
+    data = await asyncio.to_thread(parse, content)
+    MEMO[url] = (digest, data)
+    return data
+
+
+def get_url_digest(url: str) -> Optional[str]:
+    """Get a digest of the content of a metadata file, as last loaded."""
+    memo = MEMO.get(url)
+    return memo[0] if memo is not None else None
+
+
+def parse_yaml(content: bytes) -> Any:
+    return yaml.load(content, Loader=YamlLoader)
+
+
+async def load_yaml_url(url: str) -> Any:
+    if url.lower().endswith(".json"):
+        return await load_json_url(url)
+    return await load_url_cached(url, parse_yaml)
 
 
-async def fetch_url_to_path(url: str, path: Path) -> None:
+async def load_json_url(url: str) -> Any:
+    return await load_url_cached(url, orjson.loads)
+
+
+def verify_checksum(url: str, digest: str, checksum: Optional[str]) -> None:
+    if checksum is not None and digest != checksum:
+        msg = "Checksum mismatch for %s: %s (expected: %s)"
+        raise DataIntegrityError(msg % (url, digest, checksum))
+
+
+def parse_lines(lines: List[bytes]) -> List[Any]:
+    return [orjson.loads(line) for line in lines if len(line.strip())]
+
+
+class LineBuffer(object):
+    """Split a stream of data blocks into lines, decompressing them first if the
+    data is compressed."""
+
+    def __init__(self, compression: Optional[str] = None) -> None:
+        self.remainder = b""
+        self.decompressor: Optional[Decompressor] = None
+        if compression is not None:
+            self.decompressor = Decompressor(compression)
+
+    def feed(self, block: bytes) -> List[bytes]:
+        if self.decompressor is not None:
+            block = self.decompressor.decompress(block)
+        lines = (self.remainder + block).split(b"\n")
+        self.remainder = lines.pop()
+        return lines
+
+    def parse(self, block: bytes) -> List[Any]:
+        """Decode the JSON objects on all lines completed by the given block."""
+        return parse_lines(self.feed(block))
+
+    def finish(self) -> List[bytes]:
+        if self.decompressor is not None:
+            self.decompressor.finish()
+        return [self.remainder]
+
+
+def get_response_body(
+    url: str, resp: httpx.Response
+) -> Tuple[Optional[str], AsyncIterator[bytes]]:
+    """Get the compression of a data file served over HTTP, and an iterator over its
+    bytes. Compressed files and bodies with a Content-Encoding supported by the
+    `Decompressor` are returned as they are, so that they can be decompressed off
+    the event loop; the HTTP client takes care of any other encodings."""
+    encoding = resp.headers.get("content-encoding")
+    compression = get_compression(url, encoding)
+    if encoding is None or compression == ENCODINGS.get(encoding.strip().lower()):
+        return compression, resp.aiter_raw(CHUNK_SIZE)
+    return compression, resp.aiter_bytes(CHUNK_SIZE)
+
+
+async def fetch_url_to_path(
+    url: str,
+    path: Path,
+    checksum: Optional[str] = None,
+    reserve: Optional[Callable[[int], Awaitable[None]]] = None,
+) -> Optional[str]:
+    """Download a data file and return its compression. If given, `reserve` is
+    awaited with the size of each chunk before it is written to disk."""
+    digest = hashlib.sha1()
+    headers = {"Accept-Encoding": "identity"}
     async with httpx_session() as client:
-        async with client.stream("GET", url) as resp:
+        async with client.stream("GET", url, headers=headers) as resp:
             resp.raise_for_status()
+            compression, body = get_response_body(url, resp)
             async with aiofiles.open(path, "wb") as outfh:
-                async for chunk in resp.aiter_bytes():
+                async for chunk in body:
+                    digest.update(chunk)
+                    if reserve is not None:
+                        await reserve(len(chunk))
                     await outfh.write(chunk)
+    verify_checksum(url, digest.hexdigest(), checksum)
+    return compression
+
+
+class RangeNotHonored(Exception):
+    """Raised when a server answers a range request with the whole file."""
 
 
-async def read_path_lines(path: Path) -> AsyncGenerator[Any, None]:
-    async with aiofiles.open(path, "rb") as fh:
-        async for line in fh:
-            yield orjson.loads(line)
+class Segment(object):
+    """A byte range of a file which is being downloaded."""
+
+    def __init__(self, start: int, end: int) -> None:
+        self.start = start
+        self.end = end
+        self.done = asyncio.Event()
+        self.error: Optional[BaseException] = None
+
+
+class SegmentFile(object):
+    """A preallocated file which the segments of a download are written to. Reads
+    and writes run in threads, which keep going when the task waiting for them is
+    cancelled, so they are tracked and the file is only closed once all of them
+    are finished."""
+
+    def __init__(self, path: Path, length: int) -> None:
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.pending: Set[asyncio.Future[Any]] = set()
+        try:
+            os.ftruncate(self.fd, length)
+        except OSError:
+            os.close(self.fd)
+            raise
 
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        future = asyncio.ensure_future(asyncio.to_thread(func, self.fd, *args))
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return await asyncio.shield(future)
 
-async def stream_http_lines(url: str) -> AsyncGenerator[Any, None]:
+    async def write(self, data: bytes | bytearray, offset: int) -> None:
+        await self._run(os.pwrite, data, offset)
+
+    async def read(self, size: int, offset: int) -> bytes:
+        return await self._run(os.pread, size, offset)
+
+    async def close(self) -> None:
+        if len(self.pending):
+            await asyncio.wait(self.pending)
+        os.close(self.fd)
+
+
+async def fetch_segment(
+    client: httpx.AsyncClient, url: str, fh: SegmentFile, segment: Segment
+) -> None:
+    """Download a byte range of the URL into the same range of the file."""
+    offset = segment.start
     for retry in count():
         try:
+            headers = {
+                "Range": f"bytes={offset}-{segment.end - 1}",
+                "Accept-Encoding": "identity",
+            }
+            async with client.stream("GET", url, headers=headers) as resp:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    raise RangeNotHonored("Range request was not honored: %s" % url)
+                buffer = bytearray()
+                async for chunk in resp.aiter_raw():
+                    buffer.extend(chunk)
+                    if len(buffer) >= BLOCK_SIZE:
+                        await fh.write(buffer, offset)
+                        offset += len(buffer)
+                        buffer = bytearray()
+                await fh.write(buffer, offset)
+                offset += len(buffer)
+            if offset != segment.end:
+                raise httpx.ReadError("Incomplete segment: %d bytes" % offset)
+            return
+        except httpx.TransportError as exc:
+            if retry > 3:
+                raise
+            await asyncio.sleep(1.0)
+            log.error("Download HTTP error: %s, retrying..." % exc, offset=offset)
+
+
+async def read_segmented_batches(
+    url: str,
+    path: Path,
+    length: int,
+    checksum: Optional[str] = None,
+) -> AsyncGenerator[List[Any], None]:
+    """Download a file using several concurrent HTTP range requests into a
+    preallocated file, and parse its lines as soon as a contiguous prefix of the
+    file has arrived. Each range request uses its own connection."""
+    segment_size = max(1, settings.DOWNLOAD_SEGMENT_SIZE)
+    segments = [
+        Segment(start, min(start + segment_size, length))
+        for start in range(0, length, segment_size)
+    ]
+    pending: Deque[Segment] = deque(segments)
+    fh = SegmentFile(path, length)
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        while len(pending):
+            segment = pending.popleft()
+            try:
+                await fetch_segment(client, url, fh, segment)
+            except Exception as exc:
+                segment.error = exc
+            finally:
+                segment.done.set()
+
+    workers: List[asyncio.Task[None]] = []
+    concurrency = max(1, min(settings.DOWNLOAD_CONCURRENCY, len(segments)))
+    try:
+        async with segment_session(concurrency) as client:
+            for _ in range(concurrency):
+                workers.append(asyncio.create_task(worker(client)))
+            digest = hashlib.sha1()
+            buffer = LineBuffer(get_compression(url))
+            for segment in segments:
+                await segment.done.wait()
+                if segment.error is not None:
+                    raise segment.error
+                for offset in range(segment.start, segment.end, BLOCK_SIZE):
+                    size = min(BLOCK_SIZE, segment.end - offset)
+                    block = await fh.read(size, offset)
+                    digest.update(block)
+                    batch = await asyncio.to_thread(buffer.parse, block)
+                    if len(batch):
+                        yield batch
+            verify_checksum(url, digest.hexdigest(), checksum)
+            batch = parse_lines(buffer.finish())
+            if len(batch):
+                yield batch
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await fh.close()
+
+
+async def get_range_length(url: str) -> Optional[int]:
+    """Get the size of the file at the URL, if the server allows to fetch parts of
+    it using range requests."""
+    async with httpx_session() as client:
+        headers = {"Accept-Encoding": "identity"}
+        resp = await client.head(url, headers=headers)
+        try:
+            resp.raise_for_status()
+        except httpx.HTTPStatusError as exc:
+            # Some servers only accept GET, e.g. for URLs signed for downloads:
+            log.warning("Cannot check for range support: %s" % exc, url=url)
+            return None
+        if resp.headers.get("accept-ranges", "").lower() != "bytes":
+            return None
+        if "content-encoding" in resp.headers:
+            return None
+        length = resp.headers.get("content-length")
+        return int(length) if length is not None else None
+
+
+async def read_path_batches(
+    path: Path, compression: Optional[str] = None
+) -> AsyncGenerator[List[Any], None]:
+    """Read a local data file in large blocks. Reading, decompressing, splitting
+    and parsing each block happens in a worker thread, which yields the objects
+    decoded from it as a batch."""
+    buffer = LineBuffer(compression or get_compression(path.name))
+
+    def read_batch(fh: BinaryIO) -> Optional[List[Any]]:
+        block = fh.read(BLOCK_SIZE)
+        if not len(block):
+            return None
+        return buffer.parse(block)
+
+    with open(path, "rb") as fh:
+        while True:
+            batch = await asyncio.to_thread(read_batch, fh)
+            if batch is None:
+                break
+            if len(batch):
+                yield batch
+    batch = parse_lines(buffer.finish())
+    if len(batch):
+        yield batch
+
+
+async def read_path_lines(
+    path: Path, compression: Optional[str] = None
+) -> AsyncGenerator[Any, None]:
+    async for batch in read_path_batches(path, compression=compression):
+        for data in batch:
+            yield data
+
+
+async def stream_http_batches(url: str) -> AsyncGenerator[List[Any], None]:
+    # Byte offset of the end of the last complete line which has been read. After
+    # an error, the stream is resumed from there using a range request, unless the
+    # file is compressed (the offset refers to the decompressed data):
+    offset = 0
+    resumable = get_compression(url) is None
+    failed_at = -1
+    failures = 0
+    while True:
+        try:
+            headers = {}
+            if offset > 0 and resumable:
+                headers = {"Range": f"bytes={offset}-", "Accept-Encoding": "identity"}
             async with httpx_session() as client:
-                async with client.stream("GET", url) as resp:
+                async with client.stream("GET", url, headers=headers) as resp:
                     resp.raise_for_status()
-                    async for line in resp.aiter_lines():
-                        yield orjson.loads(line)
+                    position = 0
+                    if offset > 0 and resp.status_code == 206:
+                        position = offset
+                    elif offset > 0:
+                        log.warning(
+                            "Restarting stream, skipping data already read",
+                            url=url,
+                            offset=offset,
+                        )
+                    compression, body = get_response_body(url, resp)
+                    buffer = LineBuffer(compression)
+                    async for chunk in body:
+                        if compression is None:
+                            lines = buffer.feed(chunk)
+                        else:
+                            lines = await asyncio.to_thread(buffer.feed, chunk)
+                        batch: List[Any] = []
+                        for line in lines:
+                            position += len(line) + 1
+                            if position <= offset:
+                                continue
+                            if len(line.strip()):
+                                batch.append(orjson.loads(line))
+                        # Only count the batch as read once it has been consumed:
+                        if len(batch):
+                            yield batch
+                        offset = max(offset, position)
+                    batch = parse_lines(buffer.finish())
+                    if len(batch):
+                        yield batch
                     return
         except httpx.TransportError as exc:
-            if retry > 3:
+            # Only give up if the stream keeps failing without making progress:
+            failures = failures + 1 if offset == failed_at else 1
+            failed_at = offset
+            if failures > 4:
                 raise
             await asyncio.sleep(1.0)
-            log.error("Streaming index HTTP error: %s, retrying..." % exc)
+            msg = "Streaming index HTTP error: %s, retrying..." % exc
+            log.error(msg, offset=offset)
 
 
-async def load_json_lines(url: str, base_name: str) -> AsyncGenerator[Any, None]:
+async def load_json_batches(
+    url: str,
+    base_name: str,
+    checksum: Optional[str] = None,
+    size: Optional[int] = None,
+) -> AsyncGenerator[List[Any], None]:
+    """Load the objects from a JSON lines data file, in batches."""
     path = get_url_local_path(url)
     if path is not None:
         log.info("Reading local data", url=url, path=path.as_posix())
-        async for line in read_path_lines(path):
-            yield line
+        async for batch in read_path_batches(path):
+            yield batch
 
     elif not settings.STREAM_LOAD:
         path = settings.DATA_PATH.joinpath(base_name)
-        log.info("Fetching data", url=url, path=path.as_posix())
         try:
-            await fetch_url_to_path(url, path)
-            async for line in read_path_lines(path):
-                yield line
+            length = None
+            # Objects already passed on before falling back to a single request:
+            skip = 0
+            if settings.DOWNLOAD_CONCURRENCY > 1:
+                length = await get_range_length(url)
+            if length is not None:
+                if size is not None and size != length:
+                    msg = "Size mismatch for %s: %d (expected: %d)"
+                    raise DataIntegrityError(msg % (url, length, size))
+                log.info("Fetching data in segments", url=url, path=path.as_posix())
+                try:
+                    segmented = read_segmented_batches(url, path, length, checksum)
+                    async for batch in segmented:
+                        skip += len(batch)
+                        yield batch
+                    return
+                except RangeNotHonored as exc:
+                    log.warning("%s, fetching in one request" % exc, skipped=skip)
+            log.info("Fetching data", url=url, path=path.as_posix())
+            compression = await fetch_url_to_path(url, path, checksum=checksum)
+            async for batch in read_path_batches(path, compression=compression):
+                if skip >= len(batch):
+                    skip -= len(batch)
+                    continue
+                yield batch[skip:]
+                skip = 0
         finally:
             path.unlink(missing_ok=True)
     else:
         log.info("Streaming data", url=url)
-        async for line in stream_http_lines(url):
-            yield line
+        async for batch in stream_http_batches(url):
+            yield batch
+
+
+async def load_json_lines(
+    url: str,
+    base_name: str,
+    checksum: Optional[str] = None,
+    size: Optional[int] = None,
+) -> AsyncGenerator[Any, None]:
+    batches = load_json_batches(url, base_name, checksum=checksum, size=size)
+    async for batch in batches:
+        for data in batch:
+            yield data
+
+
+class Prefetcher(object):
+    """Download upcoming data files into DATA_PATH while earlier ones are being
+    read. At most `ahead` files are fetched in advance. The bytes of all downloads
+    are counted before they are written, and downloads of upcoming files pause
+    while the files on disk would take up more than `budget` bytes."""
+
+    def __init__(self, sources: List[Tuple[str, str]], ahead: int, budget: int):
+        self.sources = sources
+        self.ahead = ahead
+        self.budget = budget
+        self.tasks: Dict[int, asyncio.Task[Optional[str]]] = {}
+        self.started: Set[int] = set()
+        self.sizes: Dict[int, int] = {}
+        self.current = 0
+        self.changed = asyncio.Condition()
+
+    @property
+    def used(self) -> int:
+        return sum(self.sizes.values())
+
+    def get_path(self, idx: int) -> Path:
+        _, base_name = self.sources[idx]
+        return settings.DATA_PATH.joinpath(base_name)
+
+    async def fetch(self, idx: int) -> Optional[str]:
+        url, _ = self.sources[idx]
+        path = self.get_path(idx)
+        self.sizes[idx] = 0
+
+        async def reserve(size: int) -> None:
+            self.sizes[idx] += size
+            async with self.changed:
+                await self.changed.wait_for(
+                    lambda: idx <= self.current or self.used <= self.budget
+                )
+
+        log.info("Prefetching data", url=url, path=path.as_posix())
+        return await fetch_url_to_path(url, path, reserve=reserve)
+
+    def schedule(self, current: int) -> None:
+        end = min(len(self.sources), current + self.ahead + 1)
+        for idx in range(current, end):
+            if idx in self.started:
+                continue
+            url, _ = self.sources[idx]
+            if get_url_local_path(url) is not None:
+                continue
+            if idx > current and self.used >= self.budget:
+                break
+            self.started.add(idx)
+            self.tasks[idx] = asyncio.create_task(self.fetch(idx))
+
+    async def advance(self, idx: int) -> None:
+        """Move on to reading the file at `idx`, which lets its download continue
+        and wakes up the others, now that the previous file was deleted."""
+        self.current = idx
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def load(self) -> AsyncGenerator[List[Any], None]:
+        try:
+            for idx, (url, base_name) in enumerate(self.sources):
+                await self.advance(idx)
+                self.schedule(idx)
+                task = self.tasks.pop(idx, None)
+                if task is None:
+                    async for batch in load_json_batches(url, base_name):
+                        yield batch
+                    continue
+                try:
+                    compression = await task
+                    path = self.get_path(idx)
+                    async for batch in read_path_batches(path, compression):
+                        yield batch
+                        self.schedule(idx)
+                finally:
+                    self.get_path(idx).unlink(missing_ok=True)
+                    self.sizes.pop(idx, None)
+        finally:
+            for task in self.tasks.values():
+                task.cancel()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+            for idx in self.tasks.keys():
+                self.get_path(idx).unlink(missing_ok=True)
@@ -1,11 +1,15 @@
+import asyncio
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 from nomenklatura.dataset import DataCatalog
 
 from yente import settings
-from yente.data.loader import load_yaml_url
+from yente.logs import get_logger
+from yente.data.loader import load_yaml_url, get_url_digest
 from yente.data.dataset import Dataset
 
+log = get_logger(__name__)
+
 
 class CatalogManifest(BaseModel):
     """OpenSanctions is not one dataset but a whole collection, so this
@@ -24,6 +28,8 @@ class CatalogManifest(BaseModel):
             self.scopes.append(self.scope)
 
         for ds in data["datasets"]:
+            # The parsed catalog is cached, so don't modify it:
+            ds = dict(ds)
             if len(self.scopes):
                 ds["load"] = ds["name"] in self.scopes
             if self.namespace is not None:
@@ -53,12 +59,25 @@ class Catalog(DataCatalog[Dataset]):
     """A collection of datasets, loaded from a manifest."""
 
     instance: Optional["Catalog"] = None
+    # Digests of the manifest and catalog files the catalog was loaded from:
+    sources: Dict[str, Optional[str]] = {}
 
     @classmethod
     async def load(cls) -> "Catalog":
         manifest = await Manifest.load()
+        sources = {settings.MANIFEST: get_url_digest(settings.MANIFEST)}
+        for catalog_manifest in manifest.catalogs:
+            sources[catalog_manifest.url] = get_url_digest(catalog_manifest.url)
+        if cls.instance is not None and cls.instance.sources == sources:
+            log.info("Manifest and catalogs are unchanged")
+            return cls.instance
+        catalog = await asyncio.to_thread(cls.from_manifest, manifest)
+        catalog.sources = sources
+        return catalog
+
+    @classmethod
+    def from_manifest(cls, manifest: Manifest) -> "Catalog":
         catalog = cls(Dataset, {})
         for dmf in manifest.datasets:
             catalog.make_dataset(dmf)
-
         return catalog
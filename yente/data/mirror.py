@@ -0,0 +1,154 @@
+import yaml
+import orjson
+import shutil
+import asyncio
+from pathlib import Path
+from urllib.parse import urlparse
+from typing import Any, Dict, List, Optional
+
+from yente.logs import get_logger
+from yente.data.dataset import Dataset
+from yente.data.loader import fetch_url_to_path, load_json_url
+from yente.data.manifest import Catalog, Manifest
+from yente.data.util import get_url_local_path, write_file_atomic
+
+log = get_logger(__name__)
+
+# A mirror directory has a `manifest.yml` which loads the catalog `index.json`. The
+# files of each mirrored dataset are stored in a subdirectory named after it:
+#
+#   <name>/<version>/entities.ftm.json
+#   <name>/deltas/<version>.delta.json
+#   <name>/delta.json
+#   <name>/mirror.json
+
+
+def url_file_name(url: str, default: str) -> str:
+    name = Path(urlparse(url).path).name
+    return name if len(name) else default
+
+
+async def download(url: str, path: Path, checksum: Optional[str] = None) -> None:
+    """Download a file, only moving it into place once it is complete."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        log.info("Downloading", url=url, path=path.as_posix())
+        await fetch_url_to_path(url, tmp_path, checksum=checksum)
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+class DatasetMirror(object):
+    """The mirrored files of one dataset."""
+
+    def __init__(self, base_path: Path, base_url: str, dataset: Dataset) -> None:
+        self.dataset = dataset
+        self.path = base_path.joinpath(dataset.name)
+        self.url = f"{base_url}/{dataset.name}"
+        self.state_path = self.path.joinpath("mirror.json")
+        self.state: Dict[str, Any] = {}
+        if self.state_path.exists():
+            self.state = orjson.loads(self.state_path.read_bytes())
+
+    async def mirror_entities(self) -> str:
+        """Download the entity export of the dataset, unless the current version
+        with the same checksum has been mirrored before."""
+        url = self.dataset.entities_url
+        version = self.dataset.version
+        if url is None or version is None:
+            raise RuntimeError("No entities for dataset: %s" % self.dataset.name)
+        file_name = url_file_name(url, "entities.ftm.json")
+        path = self.path.joinpath(version, file_name)
+        checksum = self.dataset.entities_checksum
+        if (
+            path.exists()
+            and self.state.get("version") == version
+            and self.state.get("checksum") == checksum
+        ):
+            log.info("Entities are up to date", dataset=self.dataset.name)
+        else:
+            await download(url, path, checksum=checksum)
+        self.state = {"version": version, "checksum": checksum, "file": file_name}
+        return f"{self.url}/{version}/{file_name}"
+
+    async def mirror_deltas(self) -> Optional[str]:
+        """Download the delta files which are not in the mirror yet, and write a
+        delta index which points at them."""
+        if self.dataset.delta_url is None:
+            return None
+        index = await load_json_url(self.dataset.delta_url)
+        versions: Dict[str, str] = index.get("versions", {})
+        deltas_path = self.path.joinpath("deltas")
+        mirrored: Dict[str, str] = {}
+        for version, url in sorted(versions.items()):
+            file_name = f"{version}.delta.json"
+            path = deltas_path.joinpath(file_name)
+            # Delta files for a version never change once published:
+            if not path.exists():
+                await download(url, path)
+            mirrored[version] = f"{self.url}/deltas/{file_name}"
+        local_index = dict(index)
+        local_index["versions"] = mirrored
+        write_file_atomic(self.path.joinpath("delta.json"), orjson.dumps(local_index))
+        if deltas_path.exists():
+            for path in deltas_path.iterdir():
+                if path.name.removesuffix(".delta.json") not in mirrored:
+                    log.info("Removing outdated delta", path=path.as_posix())
+                    path.unlink()
+        return f"{self.url}/delta.json"
+
+    def prune(self, keep: Optional[str]) -> None:
+        """Remove mirrored exports other than the current and the given version."""
+        for path in self.path.iterdir():
+            if not path.is_dir() or path.name == "deltas":
+                continue
+            if path.name not in (self.dataset.version, keep):
+                log.info("Removing outdated export", path=path.as_posix())
+                shutil.rmtree(path)
+
+    def save(self) -> None:
+        write_file_atomic(self.state_path, orjson.dumps(self.state))
+
+
+async def mirror_catalog(base_path: Path, base_url: Optional[str] = None) -> None:
+    """Download the data of all datasets in the configured manifest which are set
+    to be loaded into a directory, and write a manifest which loads them from
+    there. `base_url` is where the directory is reachable for the yente nodes
+    which use the mirror, by default its local path."""
+    base_path = base_path.resolve()
+    base_path.mkdir(parents=True, exist_ok=True)
+    base_url = (base_url or base_path.as_uri()).rstrip("/")
+    manifest = await Manifest.load()
+    catalog = await asyncio.to_thread(Catalog.from_manifest, manifest)
+    datasets: List[Dict[str, Any]] = []
+    mirrors: List[DatasetMirror] = []
+    for data in manifest.datasets:
+        data = dict(data)
+        dataset = catalog.get(data["name"])
+        if (
+            dataset is None
+            or not dataset.load
+            or dataset.entities_url is None
+            or get_url_local_path(dataset.entities_url) is not None
+        ):
+            datasets.append(data)
+            continue
+        mirror = DatasetMirror(base_path, base_url, dataset)
+        previous = mirror.state.get("version")
+        data["entities_url"] = await mirror.mirror_entities()
+        data["delta_url"] = await mirror.mirror_deltas()
+        data["version"] = dataset.version
+        datasets.append(data)
+        mirror.save()
+        mirror.prune(keep=previous)
+        mirrors.append(mirror)
+
+    # The catalog and manifest are only updated once all files are in place:
+    index_path = base_path.joinpath("index.json")
+    write_file_atomic(index_path, orjson.dumps({"datasets": datasets}))
+    mirror_manifest = {"catalogs": [{"url": f"{base_url}/index.json"}]}
+    manifest_data = yaml.safe_dump(mirror_manifest).encode("utf-8")
+    write_file_atomic(base_path.joinpath("manifest.yml"), manifest_data)
+    log.info("Mirror is up to date", path=base_path.as_posix(), datasets=len(mirrors))
@@ -0,0 +1,133 @@
+import orjson
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from yente import settings
+from yente.logs import get_logger
+from yente.data.util import index_name_parts, index_name_keys, phonetic_names
+from yente.search.versions import system_version
+
+log = get_logger(__name__)
+local = threading.local()
+
+# Name parts, name keys and phonemes for a name:
+NameFeatures = Tuple[List[str], List[str], List[str]]
+
+
+def compute_name_features(name: str) -> NameFeatures:
+    names = [name]
+    return index_name_parts(names), index_name_keys(names), phonetic_names(names)
+
+
+class NameFeatureCache(object):
+    """An on-disk cache of the index features derived from entity names. Most names
+    are unchanged between two versions of a dataset, so a rebuild can look their
+    features up instead of computing them again. The cache is shared between
+    indexing processes and is wiped when the system version changes."""
+
+    FLUSH_SIZE = 1000
+    QUERY_SIZE = 500
+
+    def __init__(self, path: Path, version: str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, data BLOB)"
+            )
+            res = self.conn.execute("SELECT value FROM meta WHERE key = 'version'")
+            row = res.fetchone()
+            if row is None or row[0] != version:
+                log.info("Resetting name feature cache", path=path.as_posix())
+                self.conn.execute("DELETE FROM names")
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                    (version,),
+                )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.pending: Dict[str, bytes] = {}
+
+    def lookup(self, names: Iterable[str]) -> Dict[str, NameFeatures]:
+        """Get the features for the given names, computing them where needed."""
+        features: Dict[str, NameFeatures] = {}
+        missing: Set[str] = set(names)
+        if not len(missing):
+            return features
+        params = list(missing)
+        for offset in range(0, len(params), self.QUERY_SIZE):
+            batch = params[offset : offset + self.QUERY_SIZE]
+            marks = ", ".join("?" for _ in batch)
+            sql = f"SELECT name, data FROM names WHERE name IN ({marks})"
+            for name, data in self.conn.execute(sql, batch):
+                parts, keys, phonemes = orjson.loads(data)
+                features[name] = (parts, keys, phonemes)
+                missing.discard(name)
+        for name in missing:
+            features[name] = compute_name_features(name)
+            self.pending[name] = orjson.dumps(features[name])
+        if len(self.pending) >= self.FLUSH_SIZE:
+            self.flush()
+        return features
+
+    def flush(self) -> None:
+        """Write newly computed name features to disk."""
+        if not len(self.pending):
+            return
+        items = list(self.pending.items())
+        self.pending = {}
+        try:
+            self.conn.execute("BEGIN")
+            sql = "INSERT OR IGNORE INTO names (name, data) VALUES (?, ?)"
+            self.conn.executemany(sql, items)
+            self.conn.execute("COMMIT")
+        except sqlite3.OperationalError as exc:
+            # Another indexer holds the database for too long; it's just a cache.
+            log.warning("Could not write name feature cache: %s" % exc)
+            self.conn.execute("ROLLBACK")
+
+
+def get_name_cache() -> Optional[NameFeatureCache]:
+    """Get the name feature cache for the current thread, if it is enabled."""
+    if not settings.INDEX_NAME_CACHE:
+        return None
+    cache: Optional[NameFeatureCache] = getattr(local, "cache", None)
+    if cache is None:
+        path = settings.DATA_PATH.joinpath("name-features.sqlite3")
+        cache = NameFeatureCache(path, system_version())
+        local.cache = cache
+    return cache
+
+
+def flush_name_cache() -> None:
+    cache: Optional[NameFeatureCache] = getattr(local, "cache", None)
+    if cache is not None:
+        cache.flush()
+
+
+def name_features(names: List[str]) -> NameFeatures:
+    """Generate the name parts, name keys and phonetic forms of a set of names
+    for the search index."""
+    cache = get_name_cache()
+    if cache is None:
+        return index_name_parts(names), index_name_keys(names), phonetic_names(names)
+    features = cache.lookup(names)
+    parts: List[str] = []
+    keys: Set[str] = set()
+    phonemes: List[str] = []
+    for name in names:
+        name_parts, name_keys, name_phonemes = features[name]
+        parts.extend(name_parts)
+        keys.update(name_keys)
+        phonemes.extend(name_phonemes)
+    return parts, list(keys), phonemes
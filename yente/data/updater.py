@@ -1,10 +1,14 @@
+import orjson
+import sqlite3
 from typing import Optional, TypedDict, Dict, List, Any
-from typing import AsyncGenerator, Tuple
+from typing import AsyncGenerator, AsyncIterator, Tuple
 
 from yente import settings
 from yente.logs import get_logger
 from yente.data.dataset import Dataset
-from yente.data.loader import load_json_url, load_json_lines
+from yente.data.hashes import EntityHashes, hash_entity
+from yente.data.loader import load_json_url, load_json_batches
+from yente.data.loader import Prefetcher
 
 log = get_logger(__name__)
 
@@ -18,6 +22,58 @@ class EntityOp(TypedDict):
     entity: Dict[str, Any]
 
 
+async def coalesce_ops(
+    ops: AsyncIterator[EntityOp], name: str
+) -> AsyncGenerator[EntityOp, None]:
+    """Reduce a stream of entity operations to the last operation for each entity,
+    in the order of those last operations. Every ADD and MOD carries the full
+    entity, so it supersedes earlier operations, as does a DEL. Once more than
+    DELTA_COALESCE_BUFFER entities are held in memory, they are spilled to a
+    temporary database in DATA_PATH."""
+    buffer: Dict[str, Tuple[int, EntityOp]] = {}
+    spill: Optional[sqlite3.Connection] = None
+    spill_path = settings.DATA_PATH.joinpath(f"{name}-coalesce.sqlite3")
+    seq = 0
+
+    def flush(conn: sqlite3.Connection) -> None:
+        sql = "INSERT OR REPLACE INTO ops (id, seq, data) VALUES (?, ?, ?)"
+        rows = [(i, s, orjson.dumps(op)) for i, (s, op) in buffer.items()]
+        conn.executemany(sql, rows)
+        buffer.clear()
+
+    try:
+        async for op in ops:
+            entity_id = op["entity"]["id"]
+            buffer.pop(entity_id, None)
+            buffer[entity_id] = (seq, op)
+            seq += 1
+            if len(buffer) >= settings.DELTA_COALESCE_BUFFER:
+                if spill is None:
+                    spill_path.unlink(missing_ok=True)
+                    spill = sqlite3.connect(spill_path)
+                    spill.execute(
+                        "CREATE TABLE ops (id TEXT PRIMARY KEY, seq INT, data BLOB)"
+                    )
+                flush(spill)
+
+        if spill is None:
+            log.info("Coalesced entity operations", ops=seq, entities=len(buffer))
+            for _, op in buffer.values():
+                yield op
+            return
+
+        flush(spill)
+        spill.commit()
+        count = spill.execute("SELECT COUNT(*) FROM ops").fetchone()[0]
+        log.info("Coalesced entity operations", ops=seq, entities=count)
+        for (data,) in spill.execute("SELECT data FROM ops ORDER BY seq"):
+            yield orjson.loads(data)
+    finally:
+        if spill is not None:
+            spill.close()
+            spill_path.unlink(missing_ok=True)
+
+
 class DatasetUpdater(object):
     """A helper object for emitting entity operations to transition from one
     loaded dataset version to the next."""
@@ -30,6 +86,7 @@ class DatasetUpdater(object):
         self.base_version = base_version
         self.force_full = force_full
         self.delta_urls: Optional[List[Tuple[str, str]]] = None
+        self.base_hashes: Optional[EntityHashes] = None
 
     @classmethod
     async def build(
@@ -39,13 +96,16 @@ class DatasetUpdater(object):
         obj = DatasetUpdater(dataset, base_version, force_full=force_full)
         if force_full:
             return obj
-        if dataset.delta_url is None:
-            log.debug("No delta updates available for: %r" % dataset.name)
-            return obj
         if not settings.DELTA_UPDATES:
             return obj
         if obj.base_version is None or obj.target_version <= obj.base_version:
             return obj
+        if dataset.delta_url is None:
+            if settings.DELTA_SYNTHESIZE:
+                obj.base_hashes = EntityHashes.open(dataset.name, obj.base_version)
+            if obj.base_hashes is None:
+                log.debug("No delta updates available for: %r" % dataset.name)
+            return obj
 
         index: DeltaIndex = await load_json_url(dataset.delta_url)
         versions = index.get("versions", {})
@@ -82,7 +142,7 @@ class DatasetUpdater(object):
             return False
         if not settings.DELTA_UPDATES:
             return False
-        return self.delta_urls is not None
+        return self.delta_urls is not None or self.base_hashes is not None
 
     def needs_update(self) -> bool:
         """Confirm that the dataset needs to be loaded."""
@@ -109,12 +169,79 @@ class DatasetUpdater(object):
         if self.force_full or self.delta_urls is None:
             if self.dataset.entities_url is None:
                 raise RuntimeError("No entities for dataset: %s" % self.dataset.name)
+            if self.dataset.delta_url is None and settings.DELTA_SYNTHESIZE:
+                async for op in self.load_synthesized():
+                    yield op
+                return
             base_name = f"{self.dataset.name}-{self.target_version}"
-            async for data in load_json_lines(self.dataset.entities_url, base_name):
+            async for data in self.load_entities(base_name):
                 yield {"op": "ADD", "entity": data}
             return
 
-        for version, url in self.delta_urls:
-            base_name = f"{self.dataset.name}-delta-{version}"
-            async for data in load_json_lines(url, base_name):
+        ops = self.load_deltas()
+        if settings.DELTA_COALESCE and len(self.delta_urls) > 1:
+            ops = coalesce_ops(ops, self.dataset.name)
+        async for op in ops:
+            yield op
+
+    async def load_entities(self, base_name: str) -> AsyncGenerator[Any, None]:
+        """Load the full export of the dataset."""
+        if self.dataset.entities_url is None:
+            raise RuntimeError("No entities for dataset: %s" % self.dataset.name)
+        batches = load_json_batches(
+            self.dataset.entities_url,
+            base_name,
+            checksum=self.dataset.entities_checksum,
+            size=self.dataset.entities_size,
+        )
+        async for batch in batches:
+            for data in batch:
                 yield data
+
+    async def load_deltas(self) -> AsyncGenerator[EntityOp, None]:
+        """Generate the entity operations from all pending delta files."""
+        sources: List[Tuple[str, str]] = []
+        for version, url in self.delta_urls or []:
+            sources.append((url, f"{self.dataset.name}-delta-{version}"))
+        if settings.DELTA_PREFETCH > 0 and len(sources) > 1:
+            ahead = settings.DELTA_PREFETCH
+            budget = settings.DELTA_PREFETCH_BYTES
+            async for batch in Prefetcher(sources, ahead, budget).load():
+                for data in batch:
+                    yield data
+            return
+        for url, base_name in sources:
+            async for batch in load_json_batches(url, base_name):
+                for data in batch:
+                    yield data
+
+    async def load_synthesized(self) -> AsyncGenerator[EntityOp, None]:
+        """Load the full export of the dataset, recording a hash of each entity.
+        If the hashes of the indexed version are available, only emit the entities
+        which were added, modified or deleted since then."""
+        if self.dataset.entities_url is None:
+            raise RuntimeError("No entities for dataset: %s" % self.dataset.name)
+        name = self.dataset.name
+        base = None if self.force_full else self.base_hashes
+        hashes = EntityHashes.create(name, self.target_version)
+        try:
+            base_name = f"{name}-{self.target_version}"
+            async for data in self.load_entities(base_name):
+                digest = hash_entity(data)
+                hashes.add(data["id"], digest)
+                if base is None:
+                    yield {"op": "ADD", "entity": data}
+                    continue
+                previous = base.get(data["id"])
+                if previous is None:
+                    yield {"op": "ADD", "entity": data}
+                elif previous != digest:
+                    yield {"op": "MOD", "entity": data}
+            if base is not None:
+                for entity_id in base.missing_from(hashes):
+                    yield {"op": "DEL", "entity": {"id": entity_id}}
+            hashes.commit(name, self.target_version, keep=self.base_version)
+        finally:
+            hashes.close()
+            if base is not None:
+                base.close()
@@ -1,4 +1,6 @@
 import httpx
+import asyncio
+from uuid import uuid4
 from pathlib import Path
 from normality import WS
 from urllib.parse import urlparse
@@ -8,12 +10,16 @@ from followthemoney.types import registry
 from prefixdate.precision import Precision
 from contextlib import asynccontextmanager
 from typing import AsyncGenerator, Dict, List, Iterable, Optional, Set, Generator
+from typing import Any, Tuple
 from rigour.text.scripts import is_modern_alphabet
 from rigour.text.distance import levenshtein
 from fingerprints import remove_types, clean_name_light
 from nomenklatura.util import fingerprint_name, names_word_list
 
 from yente import settings
+from yente.logs import get_logger
+
+log = get_logger(__name__)
 
 
 @lru_cache(maxsize=5000)
@@ -117,6 +123,18 @@ def pick_names(names: List[str], limit: int = 3) -> List[str]:
     return picked
 
 
+def write_file_atomic(path: Path, data: bytes) -> None:
+    """Write a file by moving a complete copy into its place. Each write uses its
+    own temporary file, so that concurrent writers of the same file, or of files
+    which only differ in their suffix, never mix up their contents."""
+    tmp_path = path.with_name(f"{path.name}.{uuid4().hex}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
 def get_url_local_path(url: str) -> Optional[Path]:
     """Check if a given URL is local file path."""
     parsed = urlparse(url)
@@ -139,17 +157,110 @@ class Authenticator(httpx.Auth):
             yield request
 
 
-@asynccontextmanager
-async def httpx_session() -> AsyncGenerator[httpx.AsyncClient, None]:
-    transport = httpx.AsyncHTTPTransport(retries=3)
+class PoolTransport(httpx.AsyncHTTPTransport):
+    """An HTTP transport which counts the requests it sends and the connections it
+    opens for them, to show how well connections are being reused."""
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.requests = 0
+        self.connections = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        trace = request.extensions.get("trace")
+
+        async def count_connections(name: str, info: Dict[str, Any]) -> None:
+            if name == "connection.connect_tcp.complete":
+                self.connections += 1
+            if trace is not None:
+                await trace(name, info)
+
+        request.extensions["trace"] = count_connections
+        return await super().handle_async_request(request)
+
+
+# One HTTP client per event loop, like the search providers. Keeping a reference
+# to the loop makes sure its ID isn't reused while the client is registered:
+HttpClient = Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient, PoolTransport]
+CLIENTS: Dict[int, HttpClient] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client for the current event loop, or create it."""
+    loop = asyncio.get_running_loop()
+    if id(loop) in CLIENTS:
+        _, client, _ = CLIENTS[id(loop)]
+        if not client.is_closed:
+            return client
+    limits = httpx.Limits(
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+    )
+    transport = PoolTransport(retries=3, http2=True, limits=limits)
+    client = make_http_client(transport, http2=True, limits=limits)
+    CLIENTS[id(loop)] = (loop, client, transport)
+    return client
+
+
+def make_http_client(
+    transport: httpx.AsyncHTTPTransport, http2: bool, limits: httpx.Limits
+) -> httpx.AsyncClient:
+    """Create an HTTP client with the proxy, authentication and user agent of
+    yente."""
     proxy = settings.HTTP_PROXY if settings.HTTP_PROXY != "" else None
     headers = {"User-Agent": f"Yente/{settings.VERSION}"}
-    async with httpx.AsyncClient(
+    return httpx.AsyncClient(
         transport=transport,
-        http2=True,
+        http2=http2,
         timeout=None,
         proxy=proxy,
+        limits=limits,
         headers=headers,
         auth=Authenticator(),
-    ) as client:
+    )
+
+
+def get_http_metrics() -> Dict[str, int]:
+    """Get the request and connection counts of the current event loop's client."""
+    entry = CLIENTS.get(id(asyncio.get_running_loop()))
+    if entry is None:
+        return {"requests": 0, "connections": 0, "reused": 0}
+    _, _, transport = entry
+    return {
+        "requests": transport.requests,
+        "connections": transport.connections,
+        "reused": max(0, transport.requests - transport.connections),
+    }
+
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client of the current event loop."""
+    metrics = get_http_metrics()
+    entry = CLIENTS.pop(id(asyncio.get_running_loop()), None)
+    if entry is not None:
+        _, client, _ = entry
+        await client.aclose()
+        log.info("Closed HTTP client", **metrics)
+
+
+@asynccontextmanager
+async def httpx_session() -> AsyncGenerator[httpx.AsyncClient, None]:
+    """Use the shared HTTP client of the current event loop. The client stays open
+    once the block ends, and is closed using `close_http_client`."""
+    yield get_http_client()
+
+
+@asynccontextmanager
+async def segment_session(connections: int) -> AsyncGenerator[httpx.AsyncClient, None]:
+    """Use a separate HTTP/1.1 client for downloading the segments of a file, with
+    one connection per concurrent range request. The shared client speaks HTTP/2,
+    which would multiplex all of the range requests over a single connection."""
+    limits = httpx.Limits(max_connections=connections)
+    transport = httpx.AsyncHTTPTransport(retries=3, limits=limits)
+    client = make_http_client(transport, http2=False, limits=limits)
+    try:
         yield client
+    finally:
+        await client.aclose()
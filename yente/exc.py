@@ -9,6 +9,11 @@ class YenteError(Exception):
         self.status = status
 
 
+class DataIntegrityError(YenteError):
+    """Raised when a downloaded data file does not match its expected checksum
+    or size."""
+
+
 class YenteIndexError(YenteError):
     """Errors resulting from the search backend being unhappy."""
 
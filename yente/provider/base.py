@@ -1,12 +1,42 @@
 from asyncio import Semaphore
-from typing import Any, Dict, List, Optional
+from contextlib import nullcontext
+from typing import Any, AsyncContextManager, Callable, Dict, List, Optional
 from typing import AsyncIterator
 
 from yente import settings
+from yente.exc import IndexNotReadyError, YenteIndexError
 
 query_semaphore = Semaphore(settings.QUERY_CONCURRENCY)
 
 
+def search_semaphore(throttle: bool = True) -> AsyncContextManager[Any]:
+    """Get the semaphore which limits the concurrent queries of the API server, or
+    a no-op if the query is not to be throttled by it. The semaphore gets bound to
+    the event loop of its first contended caller, so code running on another loop
+    (e.g. in the update thread) must not use it."""
+    if throttle:
+        return query_semaphore
+    return nullcontext()
+
+
+def check_search_response(index: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    """Raise the error of a failed search from a multi-search request, in the same
+    way as for a single search."""
+    error = response.get("error")
+    if error is None:
+        return response
+    error_type = error.get("type") if isinstance(error, dict) else error
+    if error_type == "index_not_found_exception":
+        msg = (
+            f"Index {index} does not exist. This may be caused by a misconfiguration,"
+            " or the initial ingestion of data is still ongoing."
+        )
+        raise IndexNotReadyError(msg)
+    if error_type == "search_phase_execution_exception":
+        raise YenteIndexError(f"Search error: {error}", status=400)
+    raise YenteIndexError(f"Could not search index: {error}")
+
+
 class SearchProvider(object):
     async def close(self) -> None:
         raise NotImplementedError
@@ -32,8 +62,15 @@ class SearchProvider(object):
         """Create a copy of the index with the given name."""
         raise NotImplementedError
 
-    async def create_index(self, index: str) -> None:
-        """Create a new index with the given name."""
+    async def create_index(self, index: str, build: bool = False) -> None:
+        """Create a new index with the given name. If `build` is set, the index
+        is created with the build settings profile."""
+        raise NotImplementedError
+
+    async def finalize_index(self, index: str, force_merge: bool = False) -> None:
+        """Prepare an index created with the build settings profile for serving:
+        optionally force-merge it, restore the serving settings and wait for its
+        replicas to be allocated."""
         raise NotImplementedError
 
     async def delete_index(self, index: str) -> None:
@@ -56,10 +93,29 @@ class SearchProvider(object):
         sort: Optional[List[Any]] = None,
         aggregations: Optional[Dict[str, Any]] = None,
         rank_precise: bool = False,
+        throttle: bool = True,
     ) -> Dict[str, Any]:
-        """Search for entities in the index."""
+        """Search for entities in the index. Set `throttle` to false to bypass the
+        query concurrency limit of the API server, e.g. when searching from the
+        event loop of the update thread."""
         raise NotImplementedError
 
-    async def bulk_index(self, entities: AsyncIterator[Dict[str, Any]]) -> None:
-        """Index a list of entities into the search index."""
+    async def msearch(
+        self,
+        index: str,
+        searches: List[Dict[str, Any]],
+        rank_precise: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """Run several searches in one request. Each search is a request body with
+        a `query` and optionally `size`, `from`, `sort` and `aggregations`. The
+        responses are returned in the same order."""
+        raise NotImplementedError
+
+    async def bulk_index(
+        self,
+        entities: AsyncIterator[Dict[str, Any]],
+        on_ack: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        """Index a list of entities into the search index. `on_ack` is called with
+        the number of actions acknowledged by the index, in submission order."""
         raise NotImplementedError
@@ -0,0 +1,173 @@
+import time
+import orjson
+import asyncio
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Set
+from typing import Optional, Tuple
+from typing import AsyncIterator
+
+from yente import settings
+from yente.exc import YenteIndexError
+from yente.logs import get_logger
+
+log = get_logger(__name__)
+
+# A function which submits an NDJSON bulk request body to the search backend and
+# returns the decoded response:
+BulkSender = Callable[[str], Awaitable[Dict[str, Any]]]
+# A callback which is told how many more actions, in the order they were submitted,
+# have been acknowledged by the index:
+BulkAck = Callable[[int], None]
+
+
+class BulkChunk(object):
+    """A set of encoded bulk actions to be sent to the index in one request."""
+
+    def __init__(self) -> None:
+        self.items: List[bytes] = []
+        self.ids: Set[str] = set()
+        self.size = 0
+
+    def add(self, action: Dict[str, Any]) -> None:
+        op_type = action.get("_op_type", "index")
+        meta = {op_type: {"_index": action["_index"], "_id": action["_id"]}}
+        item = orjson.dumps(meta) + b"\n"
+        if op_type != "delete":
+            item += orjson.dumps(action["_source"]) + b"\n"
+        self.items.append(item)
+        self.ids.add(action["_id"])
+        self.size += len(item)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+async def iter_bulk_chunks(
+    actions: AsyncIterator[Dict[str, Any]], max_bytes: int
+) -> AsyncGenerator[BulkChunk, None]:
+    """Group bulk actions into chunks by their serialized size, rather than by
+    the number of documents. A single action larger than the limit is sent on
+    its own."""
+    chunk = BulkChunk()
+    async for action in actions:
+        chunk.add(action)
+        if chunk.size >= max_bytes:
+            yield chunk
+            chunk = BulkChunk()
+    if len(chunk):
+        yield chunk
+
+
+async def send_chunk(send: BulkSender, chunk: BulkChunk, max_retries: int) -> float:
+    """Submit a chunk to the index, retrying the items which were rejected by the
+    cluster because it was overloaded. Returns the time spent on requests."""
+    items = chunk.items
+    took = 0.0
+    for attempt in range(max_retries + 1):
+        start = time.monotonic()
+        resp = await send(b"".join(items).decode("utf-8"))
+        took += time.monotonic() - start
+        if not resp.get("errors"):
+            break
+        retry: List[bytes] = []
+        errors: List[Dict[str, Any]] = []
+        for item, result in zip(items, resp.get("items", [])):
+            op_type, res = next(iter(result.items()))
+            status = res.get("status", 500)
+            if 200 <= status < 300:
+                continue
+            # Deleting an entity that isn't in the index is not a problem:
+            if op_type == "delete" and status == 404:
+                continue
+            if status == 429:
+                retry.append(item)
+                continue
+            errors.append(res)
+        if len(errors):
+            msg = f"Could not index entities ({len(errors)} errors): {errors[0]}"
+            raise YenteIndexError(msg)
+        if not len(retry):
+            break
+        if attempt == max_retries:
+            raise YenteIndexError("Could not index entities: retries exhausted")
+        log.warning("Bulk items rejected, retrying...", items=len(retry))
+        items = retry
+        await asyncio.sleep(2 ** (attempt + 1))
+    log.debug("Bulk chunk indexed", docs=len(chunk), bytes=chunk.size, took=took)
+    return took
+
+
+async def bulk_pipeline(
+    actions: AsyncIterator[Dict[str, Any]],
+    send: BulkSender,
+    concurrency: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    max_retries: int = 3,
+    on_ack: Optional[BulkAck] = None,
+) -> None:
+    """Index a stream of bulk actions, keeping several bulk requests in flight
+    while the next chunk is being assembled. The number of requests in flight and
+    the chunk size default to the INDEX_BULK_* settings."""
+    if concurrency is None:
+        concurrency = settings.INDEX_BULK_CONCURRENCY
+    if max_bytes is None:
+        max_bytes = settings.INDEX_BULK_BYTES
+    in_flight: Dict[asyncio.Task[float], Set[str]] = {}
+    sequence: Dict[asyncio.Task[float], Tuple[int, int]] = {}
+    completed: Dict[int, int] = {}
+    next_ack = 0
+    chunks = 0
+    docs = 0
+    size = 0
+    latencies: List[float] = []
+
+    async def wait_for(tasks: List[asyncio.Task[float]]) -> None:
+        nonlocal next_ack
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            in_flight.pop(task, None)
+            latencies.append(task.result())
+            seq, count = sequence.pop(task)
+            completed[seq] = count
+        # Chunks can finish out of order, so only acknowledge the actions up to
+        # the first chunk which is still in flight:
+        while next_ack in completed:
+            count = completed.pop(next_ack)
+            if on_ack is not None:
+                on_ack(count)
+            next_ack += 1
+
+    try:
+        async for chunk in iter_bulk_chunks(actions, max_bytes):
+            # Operations on the same entity must be applied in order (e.g. an ADD
+            # and then a DEL from two delta versions), so a chunk touching an
+            # entity that is still in flight has to wait for that request:
+            while True:
+                conflicts = [
+                    t for t, ids in in_flight.items() if not ids.isdisjoint(chunk.ids)
+                ]
+                if len(conflicts):
+                    await wait_for(conflicts)
+                elif len(in_flight) >= max(1, concurrency):
+                    await wait_for(list(in_flight.keys()))
+                else:
+                    break
+            task = asyncio.create_task(send_chunk(send, chunk, max_retries))
+            in_flight[task] = chunk.ids
+            sequence[task] = (chunks, len(chunk))
+            chunks += 1
+            docs += len(chunk)
+            size += chunk.size
+        while len(in_flight):
+            await wait_for(list(in_flight.keys()))
+    finally:
+        for task in in_flight.keys():
+            task.cancel()
+    if len(latencies):
+        log.info(
+            "Bulk indexing complete",
+            chunks=chunks,
+            docs=docs,
+            bytes=size,
+            avg_latency=sum(latencies) / len(latencies),
+            max_latency=max(latencies),
+        )
@@ -4,15 +4,18 @@ import warnings
 from typing import Any, Dict, List, Optional, cast
 from typing import AsyncIterator
 from elasticsearch import AsyncElasticsearch, ElasticsearchWarning
-from elasticsearch.helpers import async_bulk, BulkIndexError
 from elasticsearch import ApiError, NotFoundError
 from elasticsearch import TransportError, ConnectionError
 
 from yente import settings
 from yente.exc import IndexNotReadyError, YenteIndexError, YenteNotFoundError
 from yente.logs import get_logger
-from yente.search.mapping import make_entity_mapping, INDEX_SETTINGS
+from yente.search.mapping import make_entity_mapping, make_index_settings
+from yente.search.mapping import INDEX_SERVING_SETTINGS
 from yente.provider.base import SearchProvider, query_semaphore
+from yente.provider.base import search_semaphore
+from yente.provider.base import check_search_response
+from yente.provider.bulk import BulkAck, bulk_pipeline
 from yente.middleware.trace_context import get_trace_context
 
 log = get_logger(__name__)
@@ -132,20 +135,44 @@ class ElasticSearchProvider(SearchProvider):
             msg = f"Could not clone index {base_version} to {target_version}: {te}"
             raise YenteIndexError(msg) from te
 
-    async def create_index(self, index: str) -> None:
-        """Create a new index with the given name."""
-        log.info("Create index", index=index)
+    async def create_index(self, index: str, build: bool = False) -> None:
+        """Create a new index with the given name. If `build` is set, the index
+        is created with the build settings profile."""
+        log.info("Create index", index=index, build=build)
         try:
             await self.client().indices.create(
                 index=index,
                 mappings=make_entity_mapping(),
-                settings=INDEX_SETTINGS,
+                settings=make_index_settings(build=build),
             )
         except ApiError as exc:
             if exc.error == "resource_already_exists_exception":
                 return
             raise YenteIndexError(f"Could not create index: {exc}") from exc
 
+    async def finalize_index(self, index: str, force_merge: bool = False) -> None:
+        """Prepare an index created with the build settings profile for serving:
+        optionally force-merge it, restore the serving settings and wait for its
+        replicas to be allocated."""
+        try:
+            if force_merge:
+                log.info("Force-merging index", index=index)
+                await self.client(request_timeout=3600).indices.forcemerge(
+                    index=index, max_num_segments=1
+                )
+            await self.client().indices.put_settings(
+                index=index,
+                settings={"index": INDEX_SERVING_SETTINGS},
+            )
+            client = self.client(request_timeout=900, ignore_status=408)
+            health = await client.cluster.health(
+                index=index, wait_for_status="green", timeout="10m"
+            )
+            if health.get("timed_out", False):
+                log.warning("Index replicas not ready", index=index)
+        except (ApiError, TransportError) as te:
+            raise YenteIndexError(f"Could not finalize index: {te}") from te
+
     async def delete_index(self, index: str) -> None:
         """Delete a given index if it exists."""
         try:
@@ -186,6 +213,7 @@ class ElasticSearchProvider(SearchProvider):
         sort: Optional[List[Any]] = None,
         aggregations: Optional[Dict[str, Any]] = None,
         rank_precise: bool = False,
+        throttle: bool = True,
     ) -> Dict[str, Any]:
         """Search for entities in the index."""
 
@@ -196,7 +224,7 @@ class ElasticSearchProvider(SearchProvider):
         search_type = "dfs_query_then_fetch" if rank_precise else None
 
         try:
-            async with query_semaphore:
+            async with search_semaphore(throttle):
                 response = await self.client().search(
                     index=index,
                     query=query,
@@ -238,15 +266,63 @@ class ElasticSearchProvider(SearchProvider):
             msg = f"Error during search: {str(exc)}"
             raise YenteIndexError(msg, status=500) from exc
 
-    async def bulk_index(self, entities: AsyncIterator[Dict[str, Any]]) -> None:
-        """Index a list of entities into the search index."""
+    async def msearch(
+        self,
+        index: str,
+        searches: List[Dict[str, Any]],
+        rank_precise: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """Run several searches in one request."""
+        search_type = "dfs_query_then_fetch" if rank_precise else None
+        body: List[Dict[str, Any]] = []
+        for search in searches:
+            body.append({})
+            body.append(search)
         try:
-            await async_bulk(
-                self.client(),
-                entities,
-                chunk_size=1000,
-                yield_ok=False,
-                stats_only=True,
+            async with query_semaphore:
+                response = await self.client().msearch(
+                    index=index,
+                    searches=body,
+                    search_type=search_type,
+                )
+                responses: List[Dict[str, Any]] = response.body["responses"]
+        except TransportError as te:
+            log.warning(
+                f"Backend connection error: {te.message}",
+                errors=te.errors,
             )
-        except BulkIndexError as exc:
+            raise YenteIndexError(f"Could not connect to index: {te.message}") from te
+        except ApiError as ae:
+            log.warning(
+                f"API error {ae.status_code}: {ae.message}",
+                index=index,
+                searches=len(searches),
+            )
+            raise YenteIndexError(f"Could not search index: {ae}") from ae
+        except (
+            KeyboardInterrupt,
+            OSError,
+            Exception,
+            asyncio.TimeoutError,
+            asyncio.CancelledError,
+        ) as exc:
+            msg = f"Error during search: {str(exc)}"
+            raise YenteIndexError(msg, status=500) from exc
+        return [check_search_response(index, r) for r in responses]
+
+    async def _bulk(self, body: str) -> Dict[str, Any]:
+        # The body is pre-encoded NDJSON, which the client passes through as-is:
+        operations: Any = body
+        try:
+            response = await self.client().bulk(operations=operations)
+            return cast(Dict[str, Any], response.body)
+        except (ApiError, TransportError) as exc:
             raise YenteIndexError(f"Could not index entities: {exc}") from exc
+
+    async def bulk_index(
+        self,
+        entities: AsyncIterator[Dict[str, Any]],
+        on_ack: Optional[BulkAck] = None,
+    ) -> None:
+        """Index a list of entities into the search index."""
+        await bulk_pipeline(entities, self._bulk, on_ack=on_ack)
@@ -4,14 +4,17 @@ import logging
 from typing import Any, Dict, List, Optional, cast
 from typing import AsyncIterator
 from opensearchpy import AsyncOpenSearch, AWSV4SignerAuth
-from opensearchpy.helpers import async_bulk, BulkIndexError
 from opensearchpy.exceptions import NotFoundError, TransportError
 
 from yente import settings
 from yente.exc import IndexNotReadyError, YenteIndexError, YenteNotFoundError
 from yente.logs import get_logger
-from yente.search.mapping import make_entity_mapping, INDEX_SETTINGS
+from yente.search.mapping import make_entity_mapping, make_index_settings
+from yente.search.mapping import INDEX_SERVING_SETTINGS
 from yente.provider.base import SearchProvider, query_semaphore
+from yente.provider.base import search_semaphore
+from yente.provider.base import check_search_response
+from yente.provider.bulk import BulkAck, bulk_pipeline
 
 log = get_logger(__name__)
 logging.getLogger("opensearch").setLevel(logging.ERROR)
@@ -127,12 +130,13 @@ class OpenSearchProvider(SearchProvider):
             msg = f"Could not clone index {base_version} to {target_version}: {te}"
             raise YenteIndexError(msg) from te
 
-    async def create_index(self, index: str) -> None:
-        """Create a new index with the given name."""
-        log.info("Create index", index=index)
+    async def create_index(self, index: str, build: bool = False) -> None:
+        """Create a new index with the given name. If `build` is set, the index
+        is created with the build settings profile."""
+        log.info("Create index", index=index, build=build)
         try:
             body = {
-                "settings": INDEX_SETTINGS,
+                "settings": make_index_settings(build=build),
                 "mappings": make_entity_mapping(),
             }
             await self.client.indices.create(index=index, body=body)
@@ -141,6 +145,32 @@ class OpenSearchProvider(SearchProvider):
                 return
             raise YenteIndexError(f"Could not create index: {exc}") from exc
 
+    async def finalize_index(self, index: str, force_merge: bool = False) -> None:
+        """Prepare an index created with the build settings profile for serving:
+        optionally force-merge it, restore the serving settings and wait for its
+        replicas to be allocated."""
+        try:
+            if force_merge:
+                log.info("Force-merging index", index=index)
+                await self.client.indices.forcemerge(
+                    index=index, max_num_segments=1, request_timeout=3600
+                )
+            await self.client.indices.put_settings(
+                index=index,
+                body={"settings": {"index": INDEX_SERVING_SETTINGS}},
+            )
+            health = await self.client.cluster.health(
+                index=index,
+                wait_for_status="green",
+                timeout="10m",
+                request_timeout=900,
+                ignore=408,
+            )
+            if health.get("timed_out", False):
+                log.warning("Index replicas not ready", index=index)
+        except TransportError as te:
+            raise YenteIndexError(f"Could not finalize index: {te}") from te
+
     async def delete_index(self, index: str) -> None:
         """Delete a given index if it exists."""
         try:
@@ -179,6 +209,7 @@ class OpenSearchProvider(SearchProvider):
         sort: Optional[List[Any]] = None,
         aggregations: Optional[Dict[str, Any]] = None,
         rank_precise: bool = False,
+        throttle: bool = True,
     ) -> Dict[str, Any]:
         """Search for entities in the index."""
 
@@ -189,7 +220,7 @@ class OpenSearchProvider(SearchProvider):
         search_type = "dfs_query_then_fetch" if rank_precise else None
 
         try:
-            async with query_semaphore:
+            async with search_semaphore(throttle):
                 body: Dict[str, Any] = {"query": query}
                 if aggregations is not None:
                     body["aggregations"] = aggregations
@@ -228,17 +259,55 @@ class OpenSearchProvider(SearchProvider):
             msg = f"Error during search: {str(exc)}"
             raise YenteIndexError(msg, status=500) from exc
 
-    async def bulk_index(self, entities: AsyncIterator[Dict[str, Any]]) -> None:
-        """Index a list of entities into the search index."""
+    async def msearch(
+        self,
+        index: str,
+        searches: List[Dict[str, Any]],
+        rank_precise: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """Run several searches in one request."""
+        search_type = "dfs_query_then_fetch" if rank_precise else None
+        body: List[Dict[str, Any]] = []
+        for search in searches:
+            body.append({})
+            body.append(search)
         try:
-            await async_bulk(
-                self.client,
-                entities,
-                chunk_size=1000,
-                yield_ok=False,
-                stats_only=True,
-                max_retries=3,
-                initial_backoff=2,
+            async with query_semaphore:
+                response = await self.client.msearch(
+                    index=index,
+                    body=body,
+                    search_type=search_type,
+                )
+                responses: List[Dict[str, Any]] = response["responses"]
+        except TransportError as ae:
+            log.warning(
+                f"API error {ae.status_code}: {ae.error}",
+                index=index,
+                searches=len(searches),
             )
-        except BulkIndexError as exc:
+            raise YenteIndexError(f"Could not search index: {ae}") from ae
+        except (
+            KeyboardInterrupt,
+            OSError,
+            Exception,
+            asyncio.TimeoutError,
+            asyncio.CancelledError,
+        ) as exc:
+            msg = f"Error during search: {str(exc)}"
+            raise YenteIndexError(msg, status=500) from exc
+        return [check_search_response(index, r) for r in responses]
+
+    async def _bulk(self, body: str) -> Dict[str, Any]:
+        try:
+            response = await self.client.bulk(body=body)
+            return cast(Dict[str, Any], response)
+        except TransportError as exc:
             raise YenteIndexError(f"Could not index entities: {exc}") from exc
+
+    async def bulk_index(
+        self,
+        entities: AsyncIterator[Dict[str, Any]],
+        on_ack: Optional[BulkAck] = None,
+    ) -> None:
+        """Index a list of entities into the search index."""
+        await bulk_pipeline(entities, self._bulk, on_ack=on_ack)
@@ -1,24 +1,143 @@
 import asyncio
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
 from fastapi import APIRouter, Depends, Query, Response, HTTPException
+from nomenklatura.matching.types import ScoringAlgorithm
 
 from yente import settings
 from yente.logs import get_logger
 from yente.data.common import ErrorResponse
 from yente.data.common import EntityMatchQuery, EntityMatchResponse, EntityExample
-from yente.data.common import EntityMatches, TotalSpec
+from yente.data.common import EntityMatches, TotalSpec, ScoredEntityResponse
 from yente.provider import SearchProvider, get_provider
 from yente.search.queries import entity_query, FilterDict
-from yente.search.search import search_entities, result_entities
+from yente.search.search import search_entities_batch, result_entities
+from yente.search.cache import get_match_cache
 from yente.data.entity import Entity
 from yente.util import limit_window
-from yente.scoring import score_results
+from yente.scoring import score_results_async
 from yente.routers.util import get_dataset, get_algorithm_by_name
 from yente.routers.util import PATH_DATASET, TS_PATTERN, ALGO_HELP
 
 log = get_logger(__name__)
 router = APIRouter()
 
+ScoredMatches = Tuple[int, List[ScoredEntityResponse]]
+
+
+class MatchScoring(object):
+    """The scoring parameters of a /match request."""
+
+    def __init__(
+        self,
+        algorithm: Type[ScoringAlgorithm],
+        limit: int,
+        threshold: float,
+        cutoff: float,
+        weights: Dict[str, float],
+    ) -> None:
+        self.algorithm = algorithm
+        self.limit = limit
+        self.threshold = threshold
+        self.cutoff = cutoff
+        self.weights = weights
+
+    async def score(self, entity: Entity, results: List[Entity]) -> ScoredMatches:
+        return await score_results_async(
+            self.algorithm,
+            entity,
+            results,
+            threshold=self.threshold,
+            cutoff=self.cutoff,
+            limit=None,
+            weights=self.weights,
+        )
+
+
+class CandidateStats(object):
+    """How many candidates were retrieved for a /match query, and in how many
+    steps beyond the first."""
+
+    def __init__(self) -> None:
+        self.candidates = 0
+        self.expansions = 0
+
+
+async def match_fixed(
+    provider: SearchProvider,
+    scoring: MatchScoring,
+    queries: List[Dict[str, Any]],
+    entities: List[Entity],
+    candidates: int,
+) -> List[Tuple[int, List[ScoredEntityResponse], CandidateStats]]:
+    """Retrieve a fixed number of candidates for each query and score them."""
+    limits = [candidates for _ in queries]
+    responses = await search_entities_batch(provider, queries, limits)
+    batches = [list(result_entities(resp)) for resp in responses]
+    # With a scoring pool, the queries of a batch are scored in parallel:
+    scorings = [scoring.score(e, batch) for e, batch in zip(entities, batches)]
+    matched = []
+    for batch, (total, scored) in zip(batches, await asyncio.gather(*scorings)):
+        stats = CandidateStats()
+        stats.candidates = len(batch)
+        matched.append((total, scored[: scoring.limit], stats))
+    return matched
+
+
+async def match_adaptive(
+    provider: SearchProvider,
+    scoring: MatchScoring,
+    queries: List[Dict[str, Any]],
+    entities: List[Entity],
+    candidates: int,
+) -> List[Tuple[int, List[ScoredEntityResponse], CandidateStats]]:
+    """Retrieve candidates for each query in growing windows, up to the given
+    number of candidates. The first window is scored, and the window is only
+    doubled while the lowest-ranked quarter of the new candidates still contains
+    matches, which suggests that there are more further down the ranking."""
+    window = min(candidates, max(settings.MATCH_ADAPTIVE_WINDOW, scoring.limit))
+    totals = [0 for _ in queries]
+    results: List[List[ScoredEntityResponse]] = [[] for _ in queries]
+    seen: List[Set[str]] = [set() for _ in queries]
+    stats = [CandidateStats() for _ in queries]
+    pending = {idx: window for idx in range(len(queries))}
+    while len(pending):
+        idxs = list(pending.keys())
+        responses = await search_entities_batch(
+            provider,
+            [queries[idx] for idx in idxs],
+            [pending[idx] for idx in idxs],
+            offsets=[stats[idx].candidates for idx in idxs],
+        )
+        batches: List[List[Entity]] = []
+        for idx, resp in zip(idxs, responses):
+            # Candidates can shift between pages when the index changes:
+            batch = [e for e in result_entities(resp) if e.id not in seen[idx]]
+            seen[idx].update(e.id for e in batch if e.id is not None)
+            batches.append(batch)
+        scorings = [scoring.score(entities[i], b) for i, b in zip(idxs, batches)]
+        scored = await asyncio.gather(*scorings)
+        next_pending: Dict[int, int] = {}
+        for idx, resp, batch, (total, ranked) in zip(idxs, responses, batches, scored):
+            size = pending[idx]
+            hits = len(resp.get("hits", {}).get("hits", []))
+            stats[idx].candidates += hits
+            totals[idx] += total
+            results[idx].extend(ranked)
+            fetched = stats[idx].candidates
+            if hits < size or fetched >= candidates:
+                continue
+            tail = set(e.id for e in batch[len(batch) - max(1, len(batch) // 4) :])
+            if any(r.match and r.id in tail for r in ranked):
+                next_pending[idx] = min(fetched, candidates - fetched)
+                stats[idx].expansions += 1
+        pending = next_pending
+
+    matched = []
+    for total, ranked, stat in zip(totals, results, stats):
+        ranked = sorted(ranked, key=lambda r: r.score, reverse=True)
+        matched.append((total, ranked[: scoring.limit], stat))
+    return matched
+
 
 @router.post(
     "/match/{dataset}",
@@ -138,12 +257,46 @@ async def match(
     queries = []
     entities = []
     responses: Dict[str, EntityMatches] = {}
+    cache = get_match_cache()
+    params: Dict[str, Any] = {}
+    if cache is not None:
+        params = {
+            "dataset": ds.name,
+            "algorithm": algorithm_type.NAME,
+            "limit": limit,
+            "threshold": threshold,
+            "cutoff": cutoff,
+            "fuzzy": fuzzy,
+            "topics": sorted(topics),
+            "include_dataset": sorted(include_dataset),
+            "exclude_schema": sorted(exclude_schema),
+            "exclude_dataset": sorted(exclude_dataset),
+            "changed_since": changed_since,
+            "weights": match.weights,
+            "adaptive": settings.MATCH_ADAPTIVE,
+            "indices": await cache.get_indices(provider),
+        }
+    hits = 0
 
     for name, example in match.queries.items():
         if example is None:
             continue
         try:
             entity = Entity.from_example(example)
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.make_key(entity, params)
+                cached = await cache.get(cache_key)
+                if cached is not None:
+                    total, scored = cached
+                    responses[name] = EntityMatches(
+                        status=200,
+                        results=scored,
+                        total=TotalSpec(value=total, relation="eq"),
+                        query=EntityExample.model_validate(entity.to_dict()),
+                    )
+                    hits += 1
+                    continue
             query = entity_query(
                 ds,
                 entity,
@@ -160,33 +313,40 @@ async def match(
                 status_code=400,
                 detail=f"Cannot parse example entity: {exc}",
             )
-        # We're using a higher limit for candidate generation, because we want to
-        # get a broad range of candidates to score against. This is a trade-off
-        # between speed and accuracy.
-        candidates = limit * settings.MATCH_CANDIDATES
-        candidates = max(20, min(settings.MAX_RESULTS, candidates))
-        queries.append(search_entities(provider, query, limit=candidates))
-        entities.append((name, entity))
+        queries.append(query)
+        entities.append((name, entity, cache_key))
     if not len(queries) and not len(responses):
         raise HTTPException(400, detail="No queries provided.")
-    results = await asyncio.gather(*queries)
+    # We're using a higher limit for candidate generation, because we want to
+    # get a broad range of candidates to score against. This is a trade-off
+    # between speed and accuracy.
+    candidates = limit * settings.MATCH_CANDIDATES
+    candidates = max(20, min(settings.MAX_RESULTS, candidates))
+    scoring = MatchScoring(
+        algorithm_type,
+        limit=limit,
+        threshold=threshold,
+        cutoff=cutoff,
+        weights=match.weights,
+    )
+    examples = [entity for (_, entity, _) in entities]
+    if settings.MATCH_ADAPTIVE:
+        scores = await match_adaptive(provider, scoring, queries, examples, candidates)
+    else:
+        scores = await match_fixed(provider, scoring, queries, examples, candidates)
 
-    for (name, entity), resp in zip(entities, results):
-        ents = result_entities(resp)
-        total, scored = score_results(
-            algorithm_type,
-            entity,
-            ents,
-            threshold=threshold,
-            cutoff=cutoff,
-            limit=limit,
-            weights=match.weights,
-        )
+    expansions = 0
+    for (name, entity, cache_key), (total, scored, stats) in zip(entities, scores):
+        expansions += stats.expansions
+        if cache is not None and cache_key is not None:
+            await cache.put(cache_key, (total, scored))
         log.info(
             f"/match/{ds.name}",
             action="match",
             schema=entity.schema.name,
             results=total,
+            candidates=stats.candidates,
+            expansions=stats.expansions,
         )
         responses[name] = EntityMatches(
             status=200,
@@ -194,6 +354,17 @@ async def match(
             total=TotalSpec(value=total, relation="eq"),
             query=EntityExample.model_validate(entity.to_dict()),
         )
+    if cache is not None:
+        response.headers["x-cache-hits"] = str(hits)
+        log.info(
+            f"/match/{ds.name}",
+            action="match_cache",
+            hits=hits,
+            total_hits=cache.hits,
+            total_misses=cache.misses,
+        )
+    if settings.MATCH_ADAPTIVE:
+        response.headers["x-match-expansions"] = str(expansions)
     response.headers["x-batch-size"] = str(len(responses))
     return EntityMatchResponse(
         responses=responses,
@@ -1,12 +1,13 @@
 import json
 import asyncio
 from urllib.parse import urljoin
-from typing import Any, Coroutine, Dict, List, Tuple, Optional
+from typing import Any, Dict, List, Tuple, Type, Optional
 from fastapi import APIRouter, Query, Form, Depends
 from fastapi import Request, Response
 from fastapi import HTTPException
 from followthemoney import model
 from followthemoney.types import registry
+from nomenklatura.matching.types import ScoringAlgorithm
 
 
 from yente import settings
@@ -31,9 +32,10 @@ from yente.data.freebase import (
 )
 from yente.search.queries import entity_query, prefix_query
 from yente.search.search import search_entities, result_entities, result_total
+from yente.search.search import search_entities_batch
 from yente.search.search import get_matchable_schemata
 from yente.provider import SearchProvider, get_provider
-from yente.scoring import score_results
+from yente.scoring import score_results_async
 from yente.util import match_prefix, limit_window, typed_url
 from yente.routers.util import PATH_DATASET, QUERY_PREFIX
 from yente.routers.util import TS_PATTERN, ALGO_HELP
@@ -153,23 +155,29 @@ async def reconcile_queries(
         msg = "Too many queries in one batch (limit: %d)" % settings.MAX_BATCH
         raise HTTPException(400, detail=msg)
 
-    tasks: List[Coroutine[Any, Any, Tuple[str, FreebaseEntityResult]]] = []
-    for k, q in queries.items():
-        task = reconcile_query(provider, k, dataset, q, algorithm, changed_since)
-        tasks.append(task)
-    results: List[Tuple[str, FreebaseEntityResult]] = await asyncio.gather(*tasks)
-    return dict(results)
+    algorithm_ = get_algorithm_by_name(algorithm)
+    prepared = [prepare_query(dataset, q, changed_since) for q in queries.values()]
+    responses = await search_entities_batch(
+        provider,
+        [query for _, query, _, _ in prepared],
+        [limit for _, _, limit, _ in prepared],
+        [offset for _, _, _, offset in prepared],
+    )
+    scorings = [
+        score_query(dataset, proxy, resp, algorithm_, limit)
+        for (proxy, _, limit, _), resp in zip(prepared, responses)
+    ]
+    results = await asyncio.gather(*scorings)
+    return dict(zip(queries.keys(), results))
 
 
-async def reconcile_query(
-    provider: SearchProvider,
-    name: str,
+def prepare_query(
     dataset: Dataset,
     query: Dict[str, Any],
-    algorithm: str,
     changed_since: Optional[str],
-) -> Tuple[str, FreebaseEntityResult]:
-    """Reconcile operation for a single query."""
+) -> Tuple[Entity, Dict[str, Any], int, int]:
+    """Build the example entity and the search query for a reconciliation query,
+    along with the limit and offset of its results."""
     limit, offset = limit_window(query.get("limit"), 0, settings.MAX_MATCHES)
     schema = query.get("type", settings.BASE_SCHEMA)
     properties: Dict[str, List[str]] = {"alias": [query.get("query", "")]}
@@ -184,11 +192,20 @@ async def reconcile_query(
 
     example = EntityExample(id=None, schema=schema, properties=dict(properties))
     proxy = Entity.from_example(example)
-    query = entity_query(dataset, proxy, fuzzy=False, changed_since=changed_since)
-    resp = await search_entities(provider, query, limit=limit, offset=offset)
-    algorithm_ = get_algorithm_by_name(algorithm)
+    search = entity_query(dataset, proxy, fuzzy=False, changed_since=changed_since)
+    return proxy, search, limit, offset
+
+
+async def score_query(
+    dataset: Dataset,
+    proxy: Entity,
+    resp: Dict[str, Any],
+    algorithm: Type[ScoringAlgorithm],
+    limit: int,
+) -> FreebaseEntityResult:
+    """Score the search results for a single reconciliation query."""
     entities = result_entities(resp)
-    total, scoreds = score_results(algorithm_, proxy, entities, limit=limit)
+    total, scoreds = await score_results_async(algorithm, proxy, entities, limit=limit)
     results = [FreebaseScoredEntity.from_scored(s) for s in scoreds]
     log.info(
         f"/reconcile/{dataset.name}",
@@ -196,7 +213,7 @@ async def reconcile_query(
         schema=proxy.schema.name,
         matches=total,
     )
-    return name, FreebaseEntityResult(result=results)
+    return FreebaseEntityResult(result=results)
 
 
 @router.get(
@@ -1,24 +1,123 @@
-from typing import Iterable, List, Optional, Type, Dict, Tuple
-from nomenklatura.matching.types import ScoringAlgorithm
+import asyncio
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Iterable, List, Optional, Type, Dict, Tuple
+from followthemoney import model
+from nomenklatura.matching import get_algorithm, LogicV1, NameMatcher
+from nomenklatura.matching import NameQualifiedMatcher
+from nomenklatura.matching.types import HeuristicAlgorithm, Feature
+from nomenklatura.matching.types import MatchingResult, ScoringAlgorithm
+from nomenklatura.matching.util import FNUL
 
 from yente import settings
 from yente.data.entity import Entity
 from yente.data.common import ScoredEntityResponse
 
+executor_lock = threading.Lock()
+_executor: Optional[Executor] = None
 
-def score_results(
+# How the heuristic algorithms combine their feature scores: the strongest main
+# feature plus the qualifiers ("max"), or a weighted sum of all features ("sum").
+COMBINERS: Dict[Any, str] = {
+    getattr(LogicV1.compute_score, "__func__"): "max",
+    getattr(NameMatcher.compute_score, "__func__"): "sum",
+    getattr(NameQualifiedMatcher.compute_score, "__func__"): "sum",
+}
+
+
+def compare_batch(
     algorithm: Type[ScoringAlgorithm],
-    entity: Entity,
-    results: Iterable[Entity],
+    query: Entity,
+    results: List[Entity],
+    override_weights: Dict[str, float] = {},
+) -> List[MatchingResult]:
+    """Score a list of candidate entities against a query entity. This gives the
+    same results as calling `algorithm.compare` for each candidate. For the
+    heuristic algorithms, the feature weights and schema compatibility are
+    resolved once per batch, and the feature scores of all candidates are
+    combined into match scores with NumPy."""
+    try:
+        import numpy as np
+    except ImportError as exc:
+        msg = "Scoring candidates in batches requires the `numpy` package."
+        raise RuntimeError(msg) from exc
+
+    combiner: Optional[str] = None
+    if issubclass(algorithm, HeuristicAlgorithm):
+        combiner = COMBINERS.get(getattr(algorithm.compute_score, "__func__", None))
+    if combiner is None or not issubclass(algorithm, HeuristicAlgorithm):
+        return [algorithm.compare(query, r, override_weights) for r in results]
+
+    features: List[Feature] = algorithm.features
+    weights = {f.name: override_weights.get(f.name, f.weight) for f in features}
+    active = [f for f in features if weights[f.name] != FNUL]
+    matchable: Dict[str, bool] = {}
+    rows: List[int] = []
+    for idx, result in enumerate(results):
+        schema = result.schema
+        if schema.name not in matchable:
+            can_match = query.schema.can_match(schema)
+            matchable[schema.name] = can_match or query.schema.name == schema.name
+        if matchable[schema.name]:
+            rows.append(idx)
+
+    funcs = [f.func for f in active]
+    values = [[func(query, results[idx]) for func in funcs] for idx in rows]
+    matrix = np.array(values, dtype=float).reshape((len(rows), len(active)))
+
+    # Apply the weights in the same order as `compute_score`, so that the floating
+    # point results are identical:
+    scores = np.zeros(len(rows))
+    if combiner == "max":
+        mains = [c for c, f in enumerate(active) if not f.qualifier]
+        main_weights = np.array([weights[active[c].name] for c in mains])
+        if len(mains):
+            scores = (matrix[:, mains] * main_weights).max(axis=1)
+        # Disabled main features still count as a zero score:
+        if len(mains) < len([f for f in features if not f.qualifier]):
+            scores = np.maximum(scores, FNUL)
+        for col, feature in enumerate(active):
+            if feature.qualifier:
+                scores = scores + matrix[:, col] * weights[feature.name]
+    else:
+        for col, feature in enumerate(active):
+            scores = scores + matrix[:, col] * weights[feature.name]
+
+    names = [f.name for f in active]
+    comparisons = [MatchingResult.make(FNUL, {}) for _ in results]
+    for row, (idx, row_values) in enumerate(zip(rows, matrix.tolist())):
+        score = min(1.0, max(FNUL, float(scores[row])))
+        comparisons[idx] = MatchingResult.make(score, dict(zip(names, row_values)))
+    return comparisons
+
+
+def compare_results(
+    algorithm: Type[ScoringAlgorithm],
+    query: Entity,
+    results: List[Entity],
+    override_weights: Dict[str, float] = {},
+) -> List[MatchingResult]:
+    """Score candidate entities against a query entity one by one, or in a batch if
+    `SCORE_BATCH` is enabled."""
+    if settings.SCORE_BATCH:
+        return compare_batch(algorithm, query, results, override_weights)
+    return [algorithm.compare(query, r, override_weights) for r in results]
+
+
+def rank_results(
+    results: List[Entity],
+    scores: Iterable[MatchingResult],
     threshold: float = settings.SCORE_THRESHOLD,
     cutoff: float = 0.0,
     limit: Optional[int] = None,
-    weights: Dict[str, float] = {},
 ) -> Tuple[int, List[ScoredEntityResponse]]:
+    """Turn the scores of the candidate entities into a ranked list of results,
+    and count the matches."""
     scored: List[ScoredEntityResponse] = []
     matches = 0
-    for proxy in results:
-        scoring = algorithm.compare(entity, proxy, override_weights=weights)
+    for proxy, scoring in zip(results, scores):
         result = ScoredEntityResponse.from_entity_result(proxy, scoring, threshold)
         if result.score <= cutoff:
             continue
@@ -30,3 +129,120 @@ def score_results(
     if limit is not None:
         scored = scored[:limit]
     return matches, scored
+
+
+def score_results(
+    algorithm: Type[ScoringAlgorithm],
+    entity: Entity,
+    results: Iterable[Entity],
+    threshold: float = settings.SCORE_THRESHOLD,
+    cutoff: float = 0.0,
+    limit: Optional[int] = None,
+    weights: Dict[str, float] = {},
+) -> Tuple[int, List[ScoredEntityResponse]]:
+    results = list(results)
+    scores = compare_results(algorithm, entity, results, override_weights=weights)
+    return rank_results(results, scores, threshold, cutoff, limit)
+
+
+def compact_entity(entity: Entity) -> Dict[str, Any]:
+    """The parts of an entity needed for scoring it, to be sent to a worker."""
+    return {
+        "id": entity.id,
+        "schema": entity.schema.name,
+        "properties": entity.properties,
+    }
+
+
+def compare_compact(
+    algorithm_name: str,
+    query: Dict[str, Any],
+    results: List[Dict[str, Any]],
+    weights: Dict[str, float],
+) -> List[Tuple[float, Dict[str, float]]]:
+    """Score compacted candidate entities against a compacted query entity. This
+    is a module-level function so that it can be run in a scoring worker
+    process."""
+    algorithm = get_algorithm(algorithm_name)
+    if algorithm is None:
+        raise ValueError("Invalid algorithm: %s" % algorithm_name)
+    entity = Entity(model, query)
+    candidates = [Entity(model, data) for data in results]
+    scores = compare_results(algorithm, entity, candidates, override_weights=weights)
+    return [(s.score, s.features) for s in scores]
+
+
+def get_score_executor() -> Optional[Executor]:
+    """Get the pool which scores match candidates away from the event loop, or
+    None if candidates are scored inline."""
+    global _executor
+    if settings.SCORE_EXECUTOR == "inline":
+        return None
+    with executor_lock:
+        if _executor is None:
+            workers = settings.SCORE_WORKERS or None
+            if settings.SCORE_EXECUTOR == "process":
+                # Spawn instead of fork: the server runs threads (e.g. the indexer)
+                # and forking a multi-threaded process is unsafe.
+                context = multiprocessing.get_context("spawn")
+                _executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="yente-score"
+                )
+        return _executor
+
+
+def close_score_executor() -> None:
+    """Shut down the scoring pool, if one was started."""
+    global _executor
+    with executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+async def score_results_async(
+    algorithm: Type[ScoringAlgorithm],
+    entity: Entity,
+    results: Iterable[Entity],
+    threshold: float = settings.SCORE_THRESHOLD,
+    cutoff: float = 0.0,
+    limit: Optional[int] = None,
+    weights: Dict[str, float] = {},
+) -> Tuple[int, List[ScoredEntityResponse]]:
+    """Score candidate entities using the configured scoring executor, so that
+    scoring a large batch does not block the event loop. Worker processes are
+    sent compact entity dicts and the name of the algorithm, and return only
+    the scores."""
+    executor = get_score_executor()
+    if executor is None:
+        return score_results(
+            algorithm,
+            entity,
+            results,
+            threshold=threshold,
+            cutoff=cutoff,
+            limit=limit,
+            weights=weights,
+        )
+    loop = asyncio.get_running_loop()
+    results = list(results)
+    if isinstance(executor, ProcessPoolExecutor):
+        query = compact_entity(entity)
+        compacted = [compact_entity(r) for r in results]
+        args = (algorithm.NAME, query, compacted, weights)
+        scores = await loop.run_in_executor(executor, compare_compact, *args)
+        matching = [MatchingResult(score=s, features=f) for s, f in scores]
+        return rank_results(results, matching, threshold, cutoff, limit)
+    func = partial(
+        score_results,
+        algorithm,
+        entity,
+        results,
+        threshold=threshold,
+        cutoff=cutoff,
+        limit=limit,
+        weights=weights,
+    )
+    return await loop.run_in_executor(executor, func)
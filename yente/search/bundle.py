@@ -0,0 +1,116 @@
+import gzip
+import orjson
+import asyncio
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, List
+
+from yente import settings
+from yente.logs import get_logger
+from yente.data.dataset import Dataset
+from yente.data.manifest import Catalog
+from yente.data.updater import DatasetUpdater
+from yente.provider import SearchProvider
+from yente.search.cache import invalidate_match_cache
+from yente.search.indexer import dataset_locked, get_index_version
+from yente.search.indexer import iter_entity_docs
+from yente.search.versions import construct_index_name, system_version
+
+log = get_logger(__name__)
+BATCH_SIZE = 1000
+
+# A bundle is a gzip-compressed NDJSON file. The first line is a header naming the
+# dataset, its version and the system version the documents were built for, each
+# following line holds the ID and source document of an entity in the index.
+
+
+async def write_bundle(dataset: Dataset, path: Path) -> None:
+    """Build the index documents for the full version of a dataset and write them
+    to a bundle file."""
+    updater = DatasetUpdater(dataset, None, force_full=True)
+    header = {
+        "system_version": system_version(),
+        "dataset": dataset.name,
+        "version": updater.target_version,
+    }
+    log.info("Writing bundle", path=path.as_posix(), **header)
+    with gzip.open(path, "wb") as fh:
+        batch: List[bytes] = [orjson.dumps(header) + b"\n"]
+        async for action in iter_entity_docs(updater, dataset.name):
+            doc = {"_id": action["_id"], "_source": action["_source"]}
+            batch.append(orjson.dumps(doc) + b"\n")
+            if len(batch) >= BATCH_SIZE:
+                await asyncio.to_thread(fh.write, b"".join(batch))
+                batch = []
+        await asyncio.to_thread(fh.write, b"".join(batch))
+
+
+def read_bundle_header(fh: gzip.GzipFile) -> Dict[str, Any]:
+    header: Dict[str, Any] = orjson.loads(fh.readline())
+    if header.get("system_version") != system_version():
+        msg = "Bundle was built for system version %r, not %r" % (
+            header.get("system_version"),
+            system_version(),
+        )
+        raise ValueError(msg)
+    return header
+
+
+async def iter_bundle_docs(
+    fh: gzip.GzipFile, index: str
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """Read bulk actions for the given index from an opened bundle file."""
+    while True:
+        lines = await asyncio.to_thread(fh.readlines, 2**20)
+        if not len(lines):
+            break
+        for line in lines:
+            doc: Dict[str, Any] = orjson.loads(line)
+            doc["_index"] = index
+            yield doc
+
+
+async def load_bundle(
+    provider: SearchProvider, path: Path, catalog: Catalog, force: bool = False
+) -> None:
+    """Index the documents in a bundle file and alias the resulting index. The
+    dataset of the bundle must be loaded according to the catalog, otherwise the
+    next index update would delete the index again. Unless forced, the bundle must
+    also hold the version listed in the catalog, and must not be older than the
+    index it replaces."""
+    alias = settings.ENTITY_INDEX
+    with gzip.open(path, "rb") as fh:
+        header = read_bundle_header(fh)
+        dataset_name: str = header["dataset"]
+        dataset = catalog.get(dataset_name)
+        if dataset is None or not dataset.load:
+            raise ValueError("Bundle dataset is not loaded: %r" % dataset_name)
+        version: str = header["version"]
+        next_index = construct_index_name(dataset_name, version)
+        async with dataset_locked(dataset):
+            if await provider.exists_index_alias(alias, next_index):
+                log.info("Index is up to date.", index=next_index)
+                return
+            current = await get_index_version(provider, dataset)
+            if not force and current is not None and version < current:
+                msg = "Bundle version %r is older than the indexed version %r"
+                raise ValueError(msg % (version, current))
+            if not force and version != dataset.version:
+                msg = "Bundle version %r does not match the catalog version %r"
+                raise ValueError(msg % (version, dataset.version))
+            log.info("Loading bundle", path=path.as_posix(), index=next_index)
+            build = settings.INDEX_BUILD_PROFILE
+            await provider.create_index(next_index, build=build)
+            try:
+                await provider.bulk_index(iter_bundle_docs(fh, next_index))
+            except Exception:
+                log.warn("Deleting partial index", index=next_index)
+                await provider.delete_index(next_index)
+                raise
+            await provider.refresh(index=next_index)
+            if build:
+                force_merge = settings.INDEX_FORCE_MERGE
+                await provider.finalize_index(next_index, force_merge=force_merge)
+            dataset_prefix = construct_index_name(dataset_name)
+            await provider.rollover_index(alias, next_index, prefix=dataset_prefix)
+    invalidate_match_cache()
+    log.info("Index is now aliased to: %s" % alias, index=next_index)
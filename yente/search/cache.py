@@ -0,0 +1,172 @@
+import time
+import orjson
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from yente import settings
+from yente.logs import get_logger
+from yente.data.entity import Entity
+from yente.data.common import ScoredEntityResponse
+from yente.provider import SearchProvider
+
+log = get_logger(__name__)
+
+# How long to rely on the list of aliased indexes before checking it again, in
+# seconds. Indexes swapped in by another process are picked up after this delay:
+ALIAS_TTL = 5.0
+
+# The number of matches and the scored results of a /match query:
+CachedMatches = Tuple[int, List[ScoredEntityResponse]]
+
+
+class MatchStore(object):
+    """A database of cached match results, shared by the server processes on a
+    host. Entries are keyed by the aliased index versions, so they never need to
+    be invalidated explicitly and simply expire."""
+
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path: Path) -> None:
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS matches "
+            "(key TEXT PRIMARY KEY, expires REAL, data BLOB)"
+        )
+        self.writes = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        sql = "SELECT data FROM matches WHERE key = ? AND expires > ?"
+        with self.lock:
+            row = self.conn.execute(sql, (key, time.time())).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def put(self, key: str, data: bytes, ttl: float) -> None:
+        now = time.time()
+        sql = "INSERT OR REPLACE INTO matches (key, expires, data) VALUES (?, ?, ?)"
+        with self.lock:
+            self.conn.execute(sql, (key, now + ttl, data))
+            self.writes += 1
+            if self.writes % self.PURGE_INTERVAL == 0:
+                self.conn.execute("DELETE FROM matches WHERE expires <= ?", (now,))
+
+
+class MatchCache(object):
+    """An LRU cache of /match results with a time-to-live. The cache key covers the
+    query entity, the matching parameters and the indexes aliased at the time of
+    the query, so that results from an outdated index are never returned. When an
+    index is rolled over in this process, the cache generation is incremented,
+    which retires all existing entries at once."""
+
+    def __init__(self, size: int, ttl: float, path: Optional[Path] = None) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, Tuple[float, CachedMatches]] = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.indices: List[str] = []
+        self.indices_expire = 0.0
+        self.store = MatchStore(path) if path is not None else None
+
+    def invalidate(self) -> None:
+        """Retire all cached results, e.g. after a new index has been aliased."""
+        self.generation += 1
+        self.indices_expire = 0.0
+
+    async def get_indices(self, provider: SearchProvider) -> List[str]:
+        """Get the indexes which are currently aliased for querying."""
+        if time.monotonic() > self.indices_expire:
+            indices = await provider.get_alias_indices(settings.ENTITY_INDEX)
+            self.indices = sorted(indices)
+            self.indices_expire = time.monotonic() + ALIAS_TTL
+        return self.indices
+
+    def make_key(self, entity: Entity, params: Dict[str, Any]) -> str:
+        """Build the cache key for a query entity and the parameters of a /match
+        request, which must include the aliased indexes. The ID of the entity is
+        not part of the key."""
+        props = {p: sorted(v) for p, v in entity.properties.items()}
+        data = {"schema": entity.schema.name, "properties": props, "params": params}
+        dump = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        digest = hashlib.sha1(dump).hexdigest()
+        return f"{self.generation}:{digest}"
+
+    async def get(self, key: str) -> Optional[CachedMatches]:
+        generation, digest = key.split(":", 1)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.entries.pop(key, None)
+        if self.store is not None and int(generation) == self.generation:
+            try:
+                data = await asyncio.to_thread(self.store.get, digest)
+            except sqlite3.Error as exc:
+                log.warning("Could not read match cache: %s" % exc)
+                data = None
+            if data is not None:
+                cached = orjson.loads(data)
+                results = [ScoredEntityResponse.model_validate(r) for r in cached[1]]
+                value = (cached[0], results)
+                self._remember(key, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: CachedMatches) -> None:
+        generation, digest = key.split(":", 1)
+        # The index was rolled over while the query ran:
+        if int(generation) != self.generation:
+            return
+        self._remember(key, value)
+        if self.store is not None:
+            total, results = value
+            dumped = [r.model_dump(mode="json", by_alias=True) for r in results]
+            data = orjson.dumps((total, dumped))
+            try:
+                await asyncio.to_thread(self.store.put, digest, data, self.ttl)
+            except sqlite3.Error as exc:
+                log.warning("Could not write match cache: %s" % exc)
+
+    def _remember(self, key: str, value: CachedMatches) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+_cache: Optional[MatchCache] = None
+
+
+def get_match_cache() -> Optional[MatchCache]:
+    """Get the /match result cache of this process, if it is enabled."""
+    global _cache
+    if not settings.MATCH_CACHE:
+        return None
+    if _cache is None:
+        path: Optional[Path] = None
+        if settings.MATCH_CACHE_STORE:
+            path = settings.DATA_PATH.joinpath("match-cache.sqlite3")
+        ttl = settings.MATCH_CACHE_TTL
+        _cache = MatchCache(settings.MATCH_CACHE_SIZE, ttl, path=path)
+    return _cache
+
+
+def invalidate_match_cache() -> None:
+    """Retire the cached /match results after the index alias was changed."""
+    if _cache is not None:
+        _cache.invalidate()
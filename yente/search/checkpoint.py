@@ -0,0 +1,94 @@
+import time
+import orjson
+from pathlib import Path
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional
+
+from yente import settings
+from yente.logs import get_logger
+
+log = get_logger(__name__)
+
+
+class IndexCheckpoint(object):
+    """Track how far the build of an index has progressed, so that an interrupted
+    build of the same index version can be resumed. The checkpoint counts the
+    entity operations from the updater whose bulk actions (and those of all the
+    operations before them) have been acknowledged by the search index."""
+
+    SAVE_INTERVAL = 10.0
+
+    def __init__(
+        self,
+        index: str,
+        base_version: Optional[str],
+        incremental: bool,
+        offset: int = 0,
+    ) -> None:
+        self.index = index
+        self.base_version = base_version
+        self.incremental = incremental
+        self.offset = offset
+        self.pending: Deque[int] = deque()
+        self.saved_at = time.monotonic()
+
+    @property
+    def path(self) -> Path:
+        return settings.DATA_PATH.joinpath("checkpoints", f"{self.index}.json")
+
+    @classmethod
+    def prune(cls, building: Iterable[str]) -> None:
+        """Delete the checkpoints of all index builds except those of the given
+        indexes, e.g. because the index was completed or deleted."""
+        keep = set(building)
+        for path in settings.DATA_PATH.joinpath("checkpoints").glob("*.json"):
+            if path.stem not in keep:
+                log.info("Deleting stale index checkpoint", index=path.stem)
+                path.unlink(missing_ok=True)
+
+    @classmethod
+    def load(
+        cls, index: str, base_version: Optional[str], incremental: bool
+    ) -> "IndexCheckpoint":
+        """Load the checkpoint of an index build, if it was started from the same
+        base version. Otherwise, return a fresh checkpoint."""
+        checkpoint = cls(index, base_version, incremental)
+        try:
+            with open(checkpoint.path, "rb") as fh:
+                data: Dict[str, Any] = orjson.loads(fh.read())
+        except (OSError, ValueError):
+            return checkpoint
+        if (
+            data.get("base_version") == base_version
+            and data.get("incremental") == incremental
+        ):
+            checkpoint.offset = int(data.get("offset", 0))
+        return checkpoint
+
+    def record(self, position: int) -> None:
+        """Note that the operation at `position` was submitted for indexing."""
+        self.pending.append(position)
+
+    def ack(self, count: int) -> None:
+        """Mark the next `count` submitted bulk actions as indexed."""
+        for _ in range(count):
+            self.offset = self.pending.popleft() + 1
+        if time.monotonic() - self.saved_at > self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self) -> None:
+        data = {
+            "index": self.index,
+            "base_version": self.base_version,
+            "incremental": self.incremental,
+            "offset": self.offset,
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as fh:
+            fh.write(orjson.dumps(data))
+        tmp_path.replace(self.path)
+        self.saved_at = time.monotonic()
+
+    def delete(self) -> None:
+        self.path.unlink(missing_ok=True)
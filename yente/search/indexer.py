@@ -1,18 +1,24 @@
 import asyncio
 import threading
-from typing import Any, AsyncGenerator, Dict, List
+import multiprocessing
+from functools import lru_cache, partial
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncGenerator, Dict, List, Set
+from typing import Optional
 from followthemoney import model
+from followthemoney.namespace import Namespace
 from followthemoney.exc import FollowTheMoneyException
 from followthemoney.types.date import DateType
 
 from yente import settings
 from yente.data.manifest import Catalog
-from yente.exc import YenteIndexError
+from yente.exc import DataIntegrityError, YenteIndexError
 from yente.logs import get_logger
 from yente.data.entity import Entity
 from yente.data.dataset import Dataset
 from yente.data import get_catalog
-from yente.data.updater import DatasetUpdater
+from yente.data.updater import DatasetUpdater, EntityOp
 from yente.search.mapping import (
     NAME_PART_FIELD,
     NAME_KEY_FIELD,
@@ -20,63 +26,212 @@ from yente.search.mapping import (
     NAME_PHONETIC_FIELD,
 )
 from yente.provider import SearchProvider, with_provider
+from yente.search.cache import invalidate_match_cache
+from yente.search.checkpoint import IndexCheckpoint
+from yente.search.pipeline import Pipeline, Stage
+from yente.search.warmup import warmup_index
 from yente.search.versions import parse_index_name
 from yente.search.versions import construct_index_name
-from yente.data.util import expand_dates, phonetic_names
-from yente.data.util import index_name_parts, index_name_keys
-
+from yente.data.util import expand_dates, close_http_client
+from yente.data.names import name_features, flush_name_cache
 
 log = get_logger(__name__)
-lock = threading.Lock()
+BuildFuture = asyncio.Future[List[Optional[Dict[str, Any]]]]
+locks: Dict[str, threading.Lock] = {}
+locks_lock = threading.Lock()
 
 
-async def iter_entity_docs(
-    updater: DatasetUpdater, index: str
-) -> AsyncGenerator[Dict[str, Any], None]:
-    dataset = updater.dataset
-    datasets = set(dataset.dataset_names)
+@lru_cache(maxsize=100)
+def _get_namespace(dataset_name: str) -> Namespace:
+    return Namespace(dataset_name)
+
+
+def build_entity_doc(
+    index: str,
+    dataset_name: str,
+    datasets: Set[str],
+    namespaced: bool,
+    data: EntityOp,
+) -> Optional[Dict[str, Any]]:
+    """Turn an entity operation into a bulk index action, or return None if the
+    entity is invalid."""
+    if data["op"] == "DEL":
+        return {
+            "_op_type": "delete",
+            "_index": index,
+            "_id": data["entity"]["id"],
+        }
+
+    try:
+        entity = Entity.from_dict(model, data["entity"])
+        entity.datasets = entity.datasets.intersection(datasets)
+        if not len(entity.datasets):
+            entity.datasets.add(dataset_name)
+        if namespaced:
+            entity = _get_namespace(dataset_name).apply(entity)
+
+        texts = entity.pop("indexText")
+        doc = entity.to_full_dict(matchable=True)
+        names: List[str] = doc.get(NAMES_FIELD, [])
+        names.extend(entity.get("weakAlias", quiet=True))
+        name_parts, name_keys, name_phonemes = name_features(names)
+        texts.extend(name_parts)
+        doc[NAME_PART_FIELD] = name_parts
+        doc[NAME_KEY_FIELD] = name_keys
+        doc[NAME_PHONETIC_FIELD] = name_phonemes
+        doc[DateType.group] = expand_dates(doc.pop(DateType.group, []))
+        doc["text"] = texts
+
+        entity_id = doc.pop("id")
+        return {"_index": index, "_id": entity_id, "_source": doc}
+    except FollowTheMoneyException as exc:
+        log.warning("Invalid entity: %s" % exc, data=data)
+        return None
+
+
+def build_entity_docs(
+    index: str,
+    dataset_name: str,
+    datasets: Set[str],
+    namespaced: bool,
+    ops: List[EntityOp],
+) -> List[Optional[Dict[str, Any]]]:
+    """Turn a chunk of entity operations into bulk index actions. This is a
+    module-level function so that it can be run in an indexing worker process."""
+    actions = [
+        build_entity_doc(index, dataset_name, datasets, namespaced, data)
+        for data in ops
+    ]
+    flush_name_cache()
+    return actions
+
+
+async def load_ops_stage(
+    stage: Stage,
+    updater: DatasetUpdater,
+    index: str,
+    skip: int,
+    ops: Dict[str, int],
+) -> None:
+    """Download and parse the entity operations of a dataset, and pass them on in
+    chunks. Operations already indexed before a checkpoint are skipped."""
     idx = 0
-    ops: Dict[str, int] = {"ADD": 0, "DEL": 0, "MOD": 0}
+    chunk: List[EntityOp] = []
     async for data in updater.load():
         if idx % 1000 == 0 and idx > 0:
             log.info("Index: %d entities..." % idx, index=index)
-        op_code = data["op"]
         idx += 1
-        ops[op_code] += 1
-        if op_code == "DEL":
-            yield {
-                "_op_type": "delete",
-                "_index": index,
-                "_id": data["entity"]["id"],
-            }
+        if idx <= skip:
             continue
+        ops[data["op"]] += 1
+        chunk.append(data)
+        if len(chunk) >= settings.INDEX_CHUNK_SIZE:
+            await stage.put(chunk, len(chunk))
+            chunk = []
+    if len(chunk):
+        await stage.put(chunk, len(chunk))
+
 
+async def build_docs_stage(
+    stage: Stage,
+    index: str,
+    dataset_name: str,
+    datasets: Set[str],
+    namespaced: bool,
+) -> None:
+    """Turn chunks of entity operations into bulk actions. With worker processes,
+    the chunks are fanned out to a pool and the pending results are passed on in
+    their original order, so that the queue size limits the chunks in flight.
+    Their entities are counted once the workers are done with them, and time spent
+    waiting for the oldest chunk to be built doesn't count as blocked."""
+    loop = asyncio.get_running_loop()
+    if settings.INDEX_PROCESSES <= 0:
+        async for chunk in stage.inputs():
+            args = (index, dataset_name, datasets, namespaced, chunk)
+            future: BuildFuture = loop.create_future()
+            future.set_result(build_entity_docs(*args))
+            await stage.put(future, len(chunk))
+        return
+
+    def built(future: BuildFuture, items: int) -> None:
+        if not future.cancelled() and future.exception() is None:
+            stage.count(items)
+
+    # Spawn instead of fork: the indexer usually runs in a thread next to the
+    # web server's event loop, and forking a multi-threaded process is unsafe.
+    context = multiprocessing.get_context("spawn")
+    workers = settings.INDEX_PROCESSES
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        pending: List[BuildFuture] = []
+        error: Optional[Exception] = None
         try:
-            entity = Entity.from_dict(model, data["entity"])
-            entity.datasets = entity.datasets.intersection(datasets)
-            if not len(entity.datasets):
-                entity.datasets.add(dataset.name)
-            if dataset.ns is not None:
-                entity = dataset.ns.apply(entity)
-
-            texts = entity.pop("indexText")
-            doc = entity.to_full_dict(matchable=True)
-            names: List[str] = doc.get(NAMES_FIELD, [])
-            names.extend(entity.get("weakAlias", quiet=True))
-            name_parts = index_name_parts(names)
-            texts.extend(name_parts)
-            doc[NAME_PART_FIELD] = name_parts
-            doc[NAME_KEY_FIELD] = index_name_keys(names)
-            doc[NAME_PHONETIC_FIELD] = phonetic_names(names)
-            doc[DateType.group] = expand_dates(doc.pop(DateType.group, []))
-            doc["text"] = texts
-
-            entity_id = doc.pop("id")
-            yield {"_index": index, "_id": entity_id, "_source": doc}
-        except FollowTheMoneyException as exc:
-            log.warning("Invalid entity: %s" % exc, data=data)
+            try:
+                async for chunk in stage.inputs():
+                    args = (index, dataset_name, datasets, namespaced, chunk)
+                    future = loop.run_in_executor(pool, build_entity_docs, *args)
+                    future.add_done_callback(partial(built, items=len(chunk)))
+                    # While the queue holds chunks the workers are still busy with,
+                    # the stage is not blocked by the next one:
+                    pending = [f for f in pending if not f.done()]
+                    while stage.queue.full() and len(pending):
+                        await asyncio.wait([pending[0]])
+                        pending = [f for f in pending if not f.done()]
+                    pending.append(future)
+                    await stage.put(future, 0)
+            except Exception as exc:
+                # The consumer gets the failure after the chunks it was already
+                # handed, so these must be finished rather than cancelled:
+                error = exc
+            # Keep the pool alive until the consumer has the results:
+            pending = [f for f in pending if not f.done()]
+            if len(pending):
+                await asyncio.wait(pending)
+            if error is not None:
+                raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+async def iter_entity_docs(
+    updater: DatasetUpdater,
+    index: str,
+    checkpoint: Optional[IndexCheckpoint] = None,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """Generate the bulk actions for a dataset update. Loading the data, building
+    the documents and consuming the actions (i.e. bulk indexing) run as separate
+    stages connected by bounded queues, so that each of them can keep working
+    while the others are busy."""
+    dataset = updater.dataset
+    datasets = set(dataset.dataset_names)
+    namespaced = dataset.ns is not None
+    skip = checkpoint.offset if checkpoint is not None else 0
+    ops: Dict[str, int] = {"ADD": 0, "DEL": 0, "MOD": 0}
+    if skip > 0:
+        log.info("Resuming from checkpoint: %d entities..." % skip, index=index)
+
+    queue_size = settings.INDEX_QUEUE_SIZE
+    async with Pipeline("index", index=index) as pipeline:
+        load = pipeline.stage("load", queue_size)
+        pipeline.start(load, load_ops_stage(load, updater, index, skip, ops))
+        # Enough chunks in flight to keep all worker processes busy:
+        build_size = max(queue_size, settings.INDEX_PROCESSES * 2)
+        build = pipeline.stage("build", build_size)
+        args = (index, dataset.name, datasets, namespaced)
+        pipeline.start(build, build_docs_stage(build, *args))
+        sink = pipeline.stage("bulk")
+        position = skip
+        async for future in sink.inputs():
+            actions = await sink.wait(future)
+            sink.count(len(actions))
+            for action in actions:
+                if action is not None:
+                    if checkpoint is not None:
+                        checkpoint.record(position)
+                    yield action
+                position += 1
     log.info(
-        "Indexed %d entities" % idx,
+        "Indexed %d entities" % (skip + sum(ops.values())),
         added=ops["ADD"],
         modified=ops["MOD"],
         deleted=ops["DEL"],
@@ -127,22 +282,43 @@ async def index_entities(
         log.info("Index is up to date.", index=next_index)
         return
 
+    checkpoint: Optional[IndexCheckpoint] = None
+    if settings.INDEX_CHECKPOINTS:
+        incremental = updater.is_incremental and not force
+        checkpoint = IndexCheckpoint.load(next_index, base_version, incremental)
+        if force or next_index not in await provider.get_all_indices():
+            checkpoint.offset = 0
+
     # await es.indices.delete(index=next_index)
+    build = False
     if updater.is_incremental and not force:
-        base_index = construct_index_name(dataset.name, updater.base_version)
-        await provider.clone_index(base_index, next_index)
+        if checkpoint is None or checkpoint.offset == 0:
+            base_index = construct_index_name(dataset.name, updater.base_version)
+            await provider.clone_index(base_index, next_index)
     else:
-        await provider.create_index(next_index)
+        build = settings.INDEX_BUILD_PROFILE
+        if checkpoint is None or checkpoint.offset == 0:
+            await provider.create_index(next_index, build=build)
 
     try:
-        docs = iter_entity_docs(updater, next_index)
-        await provider.bulk_index(docs)
-    except YenteIndexError as exc:
+        docs = iter_entity_docs(updater, next_index, checkpoint=checkpoint)
+        on_ack = checkpoint.ack if checkpoint is not None else None
+        await provider.bulk_index(docs, on_ack=on_ack)
+    except (YenteIndexError, DataIntegrityError) as exc:
         log.exception(
             "Indexing error: %s" % exc.detail,
             dataset=dataset.name,
             index=next_index,
         )
+        # A partial index built from corrupt data must not be resumed:
+        if isinstance(exc, DataIntegrityError) and checkpoint is not None:
+            checkpoint.delete()
+            checkpoint = None
+        if checkpoint is not None and checkpoint.offset > 0:
+            checkpoint.save()
+            offset = checkpoint.offset
+            log.warn("Keeping partial index", index=next_index, offset=offset)
+            raise exc
         aliases = await provider.get_alias_indices(alias)
         if next_index not in aliases:
             log.warn("Deleting partial index", index=next_index)
@@ -150,6 +326,11 @@ async def index_entities(
         raise exc
 
     await provider.refresh(index=next_index)
+    if build:
+        force_merge = settings.INDEX_FORCE_MERGE
+        await provider.finalize_index(next_index, force_merge=force_merge)
+    if settings.INDEX_WARMUP:
+        await warmup_index(provider, dataset, next_index)
     dataset_prefix = construct_index_name(dataset.name)
     # FIXME: we're not actually deleting old indexes here any more!
     await provider.rollover_index(
@@ -157,7 +338,10 @@ async def index_entities(
         next_index,
         prefix=dataset_prefix,
     )
+    invalidate_match_cache()
     log.info("Index is now aliased to: %s" % alias, index=next_index)
+    if checkpoint is not None:
+        checkpoint.delete()
 
 
 async def delete_old_indices(provider: SearchProvider, catalog: Catalog) -> None:
@@ -181,16 +365,69 @@ async def delete_old_indices(provider: SearchProvider, catalog: Catalog) -> None
             )
             await provider.delete_index(index)
 
+    # Only the checkpoints of indexes which are not aliased yet can be resumed:
+    indices = set(await provider.get_all_indices())
+    IndexCheckpoint.prune(indices.difference(aliased))
+
+
+def get_dataset_lock(dataset: Dataset) -> threading.Lock:
+    """Get the lock which guards the indexing of a particular dataset. Index
+    updates can be triggered from several threads (cron, `/updatez`), so these
+    are shared across all event loops in the process."""
+    with locks_lock:
+        if dataset.name not in locks:
+            locks[dataset.name] = threading.Lock()
+        return locks[dataset.name]
+
+
+@asynccontextmanager
+async def dataset_locked(dataset: Dataset) -> AsyncGenerator[None, None]:
+    """Hold the indexing lock of a dataset, waiting for it without blocking the
+    event loop."""
+    lock = get_dataset_lock(dataset)
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(1.0)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+async def index_entities_locked(
+    provider: SearchProvider,
+    dataset: Dataset,
+    semaphore: asyncio.Semaphore,
+    force: bool,
+) -> None:
+    """Index a dataset once a concurrency slot and the dataset's lock are free."""
+    async with semaphore:
+        async with dataset_locked(dataset):
+            await index_entities(provider, dataset, force=force)
+
 
 async def update_index(force: bool = False) -> None:
     """Reindex all datasets if there is a new version of their data contenst available,
     or create an initial version of the index from scratch."""
     async with with_provider() as provider:
         catalog = await get_catalog()
-        log.info("Index update check")
+        log.info("Index update check", concurrency=settings.INDEX_CONCURRENCY)
+        semaphore = asyncio.Semaphore(max(1, settings.INDEX_CONCURRENCY))
+        tasks = []
         for dataset in catalog.datasets:
-            with lock:
-                await index_entities(provider, dataset, force=force)
+            tasks.append(index_entities_locked(provider, dataset, semaphore, force))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Report every dataset which failed, not just the first one:
+        failures: List[BaseException] = []
+        for dataset, result in zip(catalog.datasets, results):
+            if isinstance(result, BaseException):
+                log.exception(
+                    "Dataset update error: %r" % result,
+                    dataset=dataset.name,
+                    exc_info=result,
+                )
+                failures.append(result)
+        if len(failures):
+            raise failures[0]
 
         await delete_old_indices(provider, catalog)
         log.info("Index update complete.")
@@ -202,6 +439,8 @@ def update_index_threaded(force: bool = False) -> None:
             await update_index(force=force)
         except (Exception, KeyboardInterrupt) as exc:
             log.exception("Index update error: %s" % exc)
+        finally:
+            await close_http_client()
 
     thread = threading.Thread(
         target=asyncio.run,
@@ -11,7 +11,19 @@ MappingProperty = Dict[str, Union[List[str], str]]
 
 DATE_FORMAT = "yyyy-MM-dd'T'HH||yyyy-MM-dd'T'HH:mm||yyyy-MM-dd'T'HH:mm:ss||yyyy-MM-dd||yyyy-MM||yyyy||strict_date_optional_time"  # noqa
 TEXT_TYPES = (registry.name, registry.address)
-INDEX_SETTINGS = {
+# Index settings which make the index usable for querying. An index can be
+# created with the build settings instead, which skip segment refreshes and
+# replication while bulk indexing, and then be switched to these:
+INDEX_SERVING_SETTINGS = {
+    "refresh_interval": "5s",
+    "auto_expand_replicas": "0-all",
+}
+INDEX_BUILD_SETTINGS = {
+    "refresh_interval": "-1",
+    "auto_expand_replicas": "false",
+    "number_of_replicas": 0,
+}
+INDEX_SETTINGS: Dict[str, Any] = {
     "analysis": {
         "normalizer": {
             "osa-normalizer": {
@@ -27,8 +39,7 @@ INDEX_SETTINGS = {
         },
     },
     "index": {
-        "refresh_interval": "5s",
-        "auto_expand_replicas": "0-all",
+        **INDEX_SERVING_SETTINGS,
         "number_of_shards": settings.INDEX_SHARDS,
     },
 }
@@ -38,6 +49,15 @@ NAME_KEY_FIELD = "name_keys"
 NAME_PHONETIC_FIELD = "name_phonetic"
 
 
+def make_index_settings(build: bool = False) -> Dict[str, Any]:
+    """Get the settings for a new index, optionally using the build profile."""
+    if not build:
+        return INDEX_SETTINGS
+    index_settings = dict(INDEX_SETTINGS["index"])
+    index_settings.update(INDEX_BUILD_SETTINGS)
+    return {**INDEX_SETTINGS, "index": index_settings}
+
+
 def make_field(
     type_: str, copy_to: Optional[List[str]] = None, format: Optional[str] = None
 ) -> MappingProperty:
@@ -0,0 +1,176 @@
+import time
+import asyncio
+from typing import Any, AsyncGenerator, Awaitable, Coroutine, Dict, List, Optional
+from typing import TypeVar
+
+from yente.logs import get_logger
+
+log = get_logger(__name__)
+T = TypeVar("T")
+
+# How often to log the progress of each stage of a running pipeline, in seconds:
+REPORT_INTERVAL = 30.0
+
+
+class Failure(object):
+    """Passed down the pipeline in place of an item when a stage has failed."""
+
+    def __init__(self, exc: BaseException) -> None:
+        self.exc = exc
+
+
+DONE = object()
+
+
+class Stage(object):
+    """One step of a pipeline. Each stage runs in its own task and hands its output
+    to the next stage through a bounded queue, so that a slow stage holds back the
+    ones before it rather than having them buffer data without limit."""
+
+    def __init__(self, name: str, source: Optional["Stage"], maxsize: int) -> None:
+        self.name = name
+        self.source = source
+        self.queue: asyncio.Queue[Any] = asyncio.Queue(maxsize=max(1, maxsize))
+        self.items = 0
+        # Time spent waiting for input from the previous stage, and for room in
+        # the queue to the next stage:
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.puts = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    def count(self, items: int) -> None:
+        self.items += items
+
+    async def put(self, item: Any, items: int = 1) -> None:
+        """Hand an item to the next stage, waiting while its queue is full."""
+        start = time.monotonic()
+        await self.queue.put(item)
+        self.blocked += time.monotonic() - start
+        self.count(items)
+        depth = self.queue.qsize()
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+        self.puts += 1
+
+    async def inputs(self) -> AsyncGenerator[Any, None]:
+        """Consume the output of the previous stage."""
+        if self.source is None:
+            raise RuntimeError("Stage has no input: %s" % self.name)
+        while True:
+            start = time.monotonic()
+            item = await self.source.queue.get()
+            self.starved += time.monotonic() - start
+            if item is DONE:
+                break
+            if isinstance(item, Failure):
+                raise item.exc
+            yield item
+
+    async def wait(self, pending: Awaitable[T]) -> T:
+        """Wait for the result of an item which the previous stage handed over
+        while still working on it, e.g. a future from a worker pool. The wait is
+        counted as time starved of input."""
+        start = time.monotonic()
+        try:
+            return await pending
+        finally:
+            self.starved += time.monotonic() - start
+
+    def stats(self) -> Dict[str, Any]:
+        end = self.finished or time.monotonic()
+        elapsed = max(end - self.started, 1e-6)
+        return {
+            "items": self.items,
+            "rate": round(self.items / elapsed, 1),
+            "starved": round(self.starved, 2),
+            "blocked": round(self.blocked, 2),
+            "queue": self.queue.qsize(),
+            "queue_avg": round(self.depth_total / max(1, self.puts), 1),
+            "queue_max": self.depth_max,
+        }
+
+
+class Pipeline(object):
+    """A chain of stages connected by bounded queues. The stages before the last
+    one run in background tasks, while the last one is consumed by the caller:
+
+        async with Pipeline("name") as pipeline:
+            first = pipeline.stage("first", 10)
+            pipeline.start(first, produce(first))
+            last = pipeline.stage("last")
+            async for item in last.inputs():
+                ...
+
+    The throughput of each stage, the time it spent waiting on its neighbours and
+    the depth of its queue are logged periodically and once the pipeline is done.
+    A stage which spends little time waiting while the others are starved or
+    blocked is the bottleneck."""
+
+    def __init__(self, name: str, **context: Any) -> None:
+        self.name = name
+        self.context = context
+        self.stages: List[Stage] = []
+        self.tasks: List[asyncio.Task[None]] = []
+        self.reporter: Optional[asyncio.Task[None]] = None
+
+    def stage(self, name: str, maxsize: int = 1) -> Stage:
+        source = self.stages[-1] if len(self.stages) else None
+        stage = Stage(name, source, maxsize)
+        self.stages.append(stage)
+        return stage
+
+    def start(self, stage: Stage, coro: Coroutine[Any, Any, None]) -> None:
+        """Run a stage in the background. It must put its output into the stage's
+        queue, and is marked as done when the coroutine returns."""
+        position = len(self.tasks)
+        self.tasks.append(asyncio.create_task(self._run(stage, coro, position)))
+
+    async def _run(
+        self, stage: Stage, coro: Coroutine[Any, Any, None], position: int
+    ) -> None:
+        try:
+            await coro
+        except Exception as exc:
+            # Stop the stages feeding into this one, and tell the ones after it:
+            for task in self.tasks[:position]:
+                task.cancel()
+            stage.finished = time.monotonic()
+            await stage.queue.put(Failure(exc))
+            return
+        stage.finished = time.monotonic()
+        await stage.queue.put(DONE)
+
+    def log_stats(self, message: str) -> None:
+        for stage in self.stages:
+            log.info(
+                message,
+                pipeline=self.name,
+                stage=stage.name,
+                **self.context,
+                **stage.stats(),
+            )
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            self.log_stats("Pipeline progress")
+
+    async def __aenter__(self) -> "Pipeline":
+        self.reporter = asyncio.create_task(self._report())
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        tasks = list(self.tasks)
+        if self.reporter is not None:
+            tasks.append(self.reporter)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for stage in self.stages:
+            if stage.finished is None:
+                stage.finished = time.monotonic()
+        self.log_stats("Pipeline complete")
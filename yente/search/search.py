@@ -1,3 +1,4 @@
+import asyncio
 from typing import Generator, Set
 from typing import Any, Dict, List, Optional
 from followthemoney import model
@@ -96,6 +97,31 @@ async def search_entities(
     )
 
 
+async def search_entities_batch(
+    provider: SearchProvider,
+    queries: List[Dict[str, Any]],
+    limits: List[int],
+    offsets: Optional[List[int]] = None,
+) -> List[Dict[str, Any]]:
+    """Run a batch of entity searches using multi-search requests, each with up to
+    `QUERY_BATCH_SIZE` queries. Responses are returned in the order of the
+    queries."""
+    searches: List[Dict[str, Any]] = []
+    for idx, (query, limit) in enumerate(zip(queries, limits)):
+        offset = offsets[idx] if offsets is not None else 0
+        searches.append({"query": query, "size": limit, "from": offset})
+    size = max(1, settings.QUERY_BATCH_SIZE)
+    batches = [searches[i : i + size] for i in range(0, len(searches), size)]
+    requests = [
+        provider.msearch(settings.ENTITY_INDEX, batch, rank_precise=True)
+        for batch in batches
+    ]
+    responses: List[Dict[str, Any]] = []
+    for batch_responses in await asyncio.gather(*requests):
+        responses.extend(batch_responses)
+    return responses
+
+
 async def get_entity(provider: SearchProvider, entity_id: str) -> Optional[Entity]:
     query = {
         "bool": {
@@ -0,0 +1,143 @@
+import math
+import time
+import orjson
+import asyncio
+from pathlib import Path
+from typing import List, Optional
+from followthemoney import model
+
+from yente import settings
+from yente.exc import YenteIndexError
+from yente.logs import get_logger
+from yente.data.common import EntityExample
+from yente.data.dataset import Dataset
+from yente.data.entity import Entity
+from yente.provider import SearchProvider
+from yente.search.queries import Clause, entity_query, text_query
+from yente.search.search import result_entities
+
+log = get_logger(__name__)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Get the nearest-rank percentile of a list of values."""
+    ranked = sorted(values)
+    pos = max(0, math.ceil(len(ranked) * pct / 100) - 1)
+    return ranked[pos]
+
+
+def load_warmup_queries(dataset: Dataset, path: Path) -> List[Clause]:
+    """Build the warm-up queries for a dataset from a file of recorded queries."""
+    queries: List[Clause] = []
+    with open(path, "rb") as fh:
+        for line in fh:
+            if not len(line.strip()):
+                continue
+            data = orjson.loads(line)
+            if "q" in data:
+                schema = model.get(data.get("schema") or settings.BASE_SCHEMA)
+                if schema is None:
+                    log.warning("Invalid warm-up query schema", query=data)
+                    continue
+                queries.append(text_query(dataset, schema, data["q"], simple=True))
+                continue
+            example = EntityExample.model_validate(data)
+            entity = Entity.from_example(example)
+            queries.append(entity_query(dataset, entity))
+    return queries
+
+
+async def sample_warmup_queries(
+    provider: SearchProvider, dataset: Dataset, index: str, size: int
+) -> List[Clause]:
+    """Pick a random sample of entities from the index and build both a matching
+    and a text search query for each of them."""
+    random: Clause = {"query": {"match_all": {}}, "random_score": {}}
+    query = {"function_score": random}
+    response = await provider.search(
+        index=index, query=query, size=size, throttle=False
+    )
+    queries: List[Clause] = []
+    for entity in result_entities(response):
+        if not entity.schema.matchable:
+            continue
+        queries.append(entity_query(dataset, entity))
+        queries.append(text_query(dataset, entity.schema, entity.caption, simple=True))
+    return queries
+
+
+async def run_warmup_round(
+    provider: SearchProvider,
+    index: str,
+    queries: List[Clause],
+    semaphore: asyncio.Semaphore,
+) -> List[float]:
+    """Run all warm-up queries against the index and return their latencies,
+    in milliseconds. The number of concurrent queries is limited by the given
+    semaphore rather than the one shared with the API server, which belongs to
+    a different event loop."""
+    size = settings.MATCH_PAGE * settings.MATCH_CANDIDATES
+
+    async def run(query: Clause) -> Optional[float]:
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await provider.search(
+                    index=index,
+                    query=query,
+                    size=size,
+                    rank_precise=True,
+                    throttle=False,
+                )
+            except YenteIndexError as exc:
+                log.warning("Warm-up query failed: %s" % exc.detail, index=index)
+                return None
+            return (time.monotonic() - start) * 1000
+
+    results = await asyncio.gather(*(run(q) for q in queries))
+    return [r for r in results if r is not None]
+
+
+async def warmup_index(
+    provider: SearchProvider, dataset: Dataset, index: str
+) -> List[float]:
+    """Warm up the caches of a new index by running recorded or sampled queries
+    against it. If a latency threshold is configured, keep going until the 95th
+    percentile latency of a round is below it. Returns the latencies of the last
+    round."""
+    if settings.INDEX_WARMUP_QUERIES is not None:
+        path = Path(settings.INDEX_WARMUP_QUERIES)
+        queries = await asyncio.to_thread(load_warmup_queries, dataset, path)
+    else:
+        size = settings.INDEX_WARMUP_SAMPLE
+        queries = await sample_warmup_queries(provider, dataset, index, size)
+    if not len(queries):
+        log.info("No warm-up queries", index=index)
+        return []
+    threshold = settings.INDEX_WARMUP_LATENCY
+    rounds = max(1, settings.INDEX_WARMUP_ROUNDS) if threshold > 0 else 1
+    semaphore = asyncio.Semaphore(settings.QUERY_CONCURRENCY)
+    latencies: List[float] = []
+    for round in range(1, rounds + 1):
+        latencies = await run_warmup_round(provider, index, queries, semaphore)
+        if not len(latencies):
+            return latencies
+        p95 = percentile(latencies, 95)
+        log.info(
+            "Index warm-up round",
+            index=index,
+            round=round,
+            queries=len(latencies),
+            p50=percentile(latencies, 50),
+            p95=p95,
+            max=max(latencies),
+        )
+        if threshold <= 0 or p95 <= threshold:
+            return latencies
+    log.warning(
+        "Index latency is still above the warm-up threshold",
+        index=index,
+        threshold=threshold,
+        rounds=rounds,
+    )
+    return latencies
@@ -116,7 +116,33 @@ CRON: Optional[Cron] = None
 CRONTAB = env_str("YENTE_CRONTAB", random_cron())
 AUTO_REINDEX = as_bool(env_str("YENTE_AUTO_REINDEX", "true"))
 STREAM_LOAD = as_bool(env_str("YENTE_STREAM_LOAD", "true"))
+# How many HTTP range requests to use for downloading a data file in parallel when
+# STREAM_LOAD is disabled (1 = download it in a single request). Each of them gets
+# its own HTTP/1.1 connection rather than sharing the HTTP/2 connection pool:
+DOWNLOAD_CONCURRENCY = int(env_str("YENTE_DOWNLOAD_CONCURRENCY", "4"))
+# Size of the file segments fetched by each range request, in bytes:
+_SEGMENT_SIZE = str(32 * 1024 * 1024)
+DOWNLOAD_SEGMENT_SIZE = int(env_str("YENTE_DOWNLOAD_SEGMENT_SIZE", _SEGMENT_SIZE))
 DELTA_UPDATES = as_bool(env_str("YENTE_DELTA_UPDATES", "true"))
+# Download up to this many upcoming delta files into DATA_PATH while a delta is
+# being indexed (0 = off), as long as they take up less than DELTA_PREFETCH_BYTES:
+DELTA_PREFETCH = int(env_str("YENTE_DELTA_PREFETCH", "0"))
+_PREFETCH_BYTES = str(1024 * 1024 * 1024)
+DELTA_PREFETCH_BYTES = int(env_str("YENTE_DELTA_PREFETCH_BYTES", _PREFETCH_BYTES))
+# Reduce the operations from several delta files to one per entity before indexing,
+# holding up to DELTA_COALESCE_BUFFER entities in memory before spilling to disk:
+DELTA_COALESCE = as_bool(env_str("YENTE_DELTA_COALESCE", "false"))
+DELTA_COALESCE_BUFFER = int(env_str("YENTE_DELTA_COALESCE_BUFFER", "50000"))
+# Generate delta updates for datasets without a `delta_url` by comparing entity
+# hashes against the previously indexed version, stored in DATA_PATH:
+DELTA_SYNTHESIZE = as_bool(env_str("YENTE_DELTA_SYNTHESIZE", "false"))
+# Limits of the connection pool used for fetching metadata and data files:
+HTTP_MAX_CONNECTIONS = int(env_str("YENTE_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(env_str("YENTE_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(env_str("YENTE_HTTP_KEEPALIVE_EXPIRY", "30"))
+# Keep copies of remote manifests and catalog metadata in DATA_PATH, and only
+# download them again if they have changed on the server:
+HTTP_CACHE = as_bool(env_str("YENTE_HTTP_CACHE", "true"))
 DEFAULT_ALGORITHM = env_str("YENTE_DEFAULT_ALGORITHM", "logic-v1")
 BEST_ALGORITHM = env_str("YENTE_BEST_ALGORITHM", "logic-v1")
 
@@ -151,12 +177,52 @@ MAX_MATCHES = int(env_str("YENTE_MAX_MATCHES", "500"))
 # How many candidates to retrieve as a multiplier of the /match limit:
 MATCH_CANDIDATES = int(env_str("YENTE_MATCH_CANDIDATES", "10"))
 
+# Retrieve /match candidates adaptively: score a small window of candidates first,
+# and only fetch more while the lowest-ranked candidates still score as matches:
+MATCH_ADAPTIVE = as_bool(env_str("YENTE_MATCH_ADAPTIVE", "false"))
+
+# How many candidates to retrieve at first in adaptive mode, if the /match limit
+# is lower than this:
+MATCH_ADAPTIVE_WINDOW = int(env_str("YENTE_MATCH_ADAPTIVE_WINDOW", "20"))
+
 # Whether to run expensive levenshtein queries inside ElasticSearch:
 MATCH_FUZZY = as_bool(env_str("YENTE_MATCH_FUZZY", "true"))
 
+# Cache /match results in memory, keyed by the query and the versions of the indexes
+# it ran against, so that repeated queries skip search and scoring:
+MATCH_CACHE = as_bool(env_str("YENTE_MATCH_CACHE", "false"))
+
+# How many /match results to keep in the cache of each server process:
+MATCH_CACHE_SIZE = int(env_str("YENTE_MATCH_CACHE_SIZE", "10000"))
+
+# How long to keep cached /match results, in seconds:
+MATCH_CACHE_TTL = int(env_str("YENTE_MATCH_CACHE_TTL", "3600"))
+
+# Also keep cached /match results in a database in DATA_PATH, which is shared by
+# all server processes on the host:
+MATCH_CACHE_STORE = as_bool(env_str("YENTE_MATCH_CACHE_STORE", "false"))
+
 # How many match and search queries to run against ES in parallel:
 QUERY_CONCURRENCY = int(env_str("YENTE_QUERY_CONCURRENCY", "10"))
 
+# How many /match and reconciliation queries to send to the index in one
+# multi-search request; larger batches are split up and sent in parallel:
+QUERY_BATCH_SIZE = int(env_str("YENTE_QUERY_BATCH_SIZE", "20"))
+
+# Where to score /match and reconciliation candidates: "inline" on the event loop,
+# in a "thread" pool (for algorithms which release the GIL) or in a "process" pool:
+SCORE_EXECUTOR = env_str("YENTE_SCORE_EXECUTOR", "inline").lower().strip()
+if SCORE_EXECUTOR not in ["inline", "thread", "process"]:
+    raise ValueError(f"Invalid score executor: {SCORE_EXECUTOR}")
+
+# How many scoring threads or processes to run (0 = one per CPU):
+SCORE_WORKERS = int(env_str("YENTE_SCORE_WORKERS", "0"))
+
+# Combine the feature scores of all candidates of a query with NumPy, rather than
+# scoring them one by one. This replicates the score combination of nomenklatura's
+# heuristic algorithms, and requires the `numpy` package:
+SCORE_BATCH = as_bool(env_str("YENTE_SCORE_BATCH", "false"))
+
 # Default scoring threshold for /match results:
 SCORE_THRESHOLD = 0.70
 
@@ -184,6 +250,59 @@ ENTITY_INDEX = f"{INDEX_NAME}-entities"
 INDEX_VERSION = env_str("YENTE_INDEX_VERSION", "011")
 assert len(INDEX_VERSION) == 3, "Index version must be 3 characters long."
 
+# How many datasets to index at the same time:
+INDEX_CONCURRENCY = int(env_str("YENTE_INDEX_CONCURRENCY", "1"))
+
+# How many worker processes to use for building index documents (0 = in-process):
+INDEX_PROCESSES = int(env_str("YENTE_INDEX_PROCESSES", "0"))
+
+# How many entities to send to an indexing worker process at a time:
+INDEX_CHUNK_SIZE = int(env_str("YENTE_INDEX_CHUNK_SIZE", "500"))
+
+# How many chunks of entities to buffer between the stages of the indexing
+# pipeline (loading, building documents, bulk indexing):
+INDEX_QUEUE_SIZE = int(env_str("YENTE_INDEX_QUEUE_SIZE", "8"))
+
+# How many bulk indexing requests to keep in flight at the same time:
+INDEX_BULK_CONCURRENCY = int(env_str("YENTE_INDEX_BULK_CONCURRENCY", "4"))
+
+# Size of a bulk indexing request, in bytes of serialized documents:
+INDEX_BULK_BYTES = int(env_str("YENTE_INDEX_BULK_BYTES", str(10 * 1024 * 1024)))
+
+# Keep a cache of the index features derived from entity names in DATA_PATH:
+INDEX_NAME_CACHE = as_bool(env_str("YENTE_INDEX_NAME_CACHE", "false"))
+
+# Record the progress of index builds in DATA_PATH, so that they can be resumed.
+# A resumed build skips the entities which were already indexed, but still has to
+# download and parse the data file from the start:
+INDEX_CHECKPOINTS = as_bool(env_str("YENTE_INDEX_CHECKPOINTS", "false"))
+
+# Create new indexes without refreshes and replicas, and restore those only
+# once all entities have been indexed:
+INDEX_BUILD_PROFILE = as_bool(env_str("YENTE_INDEX_BUILD_PROFILE", "false"))
+
+# Force-merge indexes built with the build profile before they are aliased:
+INDEX_FORCE_MERGE = as_bool(env_str("YENTE_INDEX_FORCE_MERGE", "false"))
+
+# Run queries against a new index before it is aliased, so that it is not queried
+# with cold caches:
+INDEX_WARMUP = as_bool(env_str("YENTE_INDEX_WARMUP", "false"))
+
+# A JSON lines file of recorded warm-up queries, either entity examples (as used in
+# the matching API) or `{"q": "..."}` search queries:
+INDEX_WARMUP_QUERIES = env_get("YENTE_INDEX_WARMUP_QUERIES")
+
+# How many entities to sample from a new index as warm-up queries, if no recorded
+# queries are configured:
+INDEX_WARMUP_SAMPLE = int(env_str("YENTE_INDEX_WARMUP_SAMPLE", "100"))
+
+# Repeat the warm-up until the 95th percentile query latency is below this many
+# milliseconds before aliasing the new index (0 = run it once):
+INDEX_WARMUP_LATENCY = float(env_str("YENTE_INDEX_WARMUP_LATENCY", "0"))
+
+# How many warm-up rounds to run at most while waiting for the latency threshold:
+INDEX_WARMUP_ROUNDS = int(env_str("YENTE_INDEX_WARMUP_ROUNDS", "5"))
+
 # ElasticSearch-only options:
 ES_CLOUD_ID = env_get("YENTE_ELASTICSEARCH_CLOUD_ID")
 